@@ -0,0 +1,110 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from tortoise.functions import Sum
+
+from fircode import config
+from fircode.models import Dog, FeedRequest
+from fircode.sorted_keys import SortedKeys
+
+
+class Allocator:
+    """Dogs sorted by food they got and are about to get, the hungriest first
+
+    A dog's level is its feed amount plus its pending feed requests. Keys are (level, dog id),
+    they're updated in O(log n) when requests are added, deleted or declined (an approval moves
+    food from pending to feed amount, so the level stays).
+    """
+
+    def __init__(self, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self._keys = SortedKeys()
+        self._feed_amounts: Dict[int, int] = {}
+        self._pending: Dict[int, int] = {}
+        self._built_at: Optional[float] = None
+
+    def load(self, feed_amounts: List[Tuple[int, int]], pending: List[Tuple[int, int]]) -> None:
+        self._feed_amounts = dict(feed_amounts)
+        self._pending = {dog_id: amount for dog_id, amount in pending if dog_id in self._feed_amounts and amount}
+        self._keys = SortedKeys((self._level(dog_id), dog_id) for dog_id in self._feed_amounts)
+        self._built_at = time.monotonic()
+
+    async def rebuild(self) -> None:
+        """Load feed amounts and pending feed requests of all dogs from the database"""
+        feed_amounts = await Dog.all().values_list("id", "feed_amount")
+        pending = await FeedRequest.filter(approved=False).annotate(pending=Sum("feed_amount")) \
+            .group_by("target_id").values_list("target_id", "pending")
+        self.load(feed_amounts, pending)
+
+    async def ensure_fresh(self) -> None:
+        """Rebuild the allocator, if other workers could change the database since the last build"""
+        if self._built_at is None or time.monotonic() - self._built_at > self.refresh_interval:
+            await self.rebuild()
+
+    def invalidate(self) -> None:
+        """Rebuild on the next query (call it after bulk changes)"""
+        self._built_at = None
+
+    def _level(self, dog_id: int) -> int:
+        return self._feed_amounts[dog_id] + self._pending.get(dog_id, 0)
+
+    def _update(self, dog_id: int, feed_amount: int, pending: int) -> None:
+        self.remove(dog_id)
+        self._feed_amounts[dog_id] = feed_amount
+        if pending:
+            self._pending[dog_id] = pending
+        self._keys.add((self._level(dog_id), dog_id))
+
+    def set_feed_amount(self, dog_id: int, feed_amount: int) -> None:
+        """Add a dog or change its feed amount, pending feed requests are kept"""
+        self._update(dog_id, feed_amount, self._pending.get(dog_id, 0))
+
+    def add_pending(self, dog_id: int, amount: int) -> None:
+        """Account a feed request (negative amount for a deleted or declined one)"""
+        if dog_id in self._feed_amounts:
+            self._update(dog_id, self._feed_amounts[dog_id], max(0, self._pending.get(dog_id, 0) + amount))
+
+    def approve(self, dog_id: int, amount: int) -> None:
+        """Move food of an approved feed request from pending to the feed amount"""
+        if dog_id in self._feed_amounts:
+            self._update(dog_id, self._feed_amounts[dog_id] + amount, max(0, self._pending.get(dog_id, 0) - amount))
+
+    def remove(self, dog_id: int) -> None:
+        if dog_id in self._feed_amounts:
+            self._keys.remove((self._level(dog_id), dog_id))
+            del self._feed_amounts[dog_id]
+            self._pending.pop(dog_id, None)
+
+    def allocate(self, units: int, max_dogs: int) -> List[Tuple[int, int]]:
+        """Returns (dog id, units) of a donation split among at most max_dogs hungriest dogs
+
+        The hungriest dogs are raised to a common level, so a small donation goes to one dog
+        and a large one is spread. Takes O(max_dogs + log n).
+        """
+        candidates = self._keys[:max_dogs]
+        if units <= 0 or not candidates:
+            return []
+        # Add dogs while the common level, which the units reach, is above the next dog's level
+        total = count = 0
+        for level, _ in candidates:
+            if count and (total + units) / count <= level:
+                break
+            total += level
+            count += 1
+        common_level, extra = divmod(total + units, count)
+        allocation = []
+        for index, (level, dog_id) in enumerate(candidates[:count]):
+            share = common_level - level + (1 if index < extra else 0)
+            if share > 0:
+                allocation.append((dog_id, share))
+        return allocation
+
+    def level(self, dog_id: int) -> Tuple[int, int]:
+        """Returns feed amount and pending feed of the dog"""
+        return self._feed_amounts.get(dog_id, 0), self._pending.get(dog_id, 0)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+allocator = Allocator(refresh_interval=config.allocation_refresh_interval)
@@ -0,0 +1,286 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from tortoise import connections
+from tortoise.exceptions import IntegrityError
+from tortoise.models import Model
+
+from fircode import config
+from fircode.allocation import allocator
+from fircode.leaderboard import leaderboard
+from fircode.models import BulkFormat, BulkKind, Dog, DogImportRow, FeedRequest, FeedRequestImportRow, \
+    ImportResult, ImportRowError, User, UserImportRow
+from fircode.pagination import Keyset, iterate_values, stream_batch_size
+from fircode.password_hasher import password_hasher
+from fircode.response_cache import dog_cache
+from fircode.serialization import dumps
+
+import_formats = {
+    "text/csv": BulkFormat.csv,
+    "application/x-ndjson": BulkFormat.ndjson,
+    "application/jsonl": BulkFormat.ndjson,
+}
+export_media_types = {
+    BulkFormat.csv: "text/csv; charset=utf-8",
+    BulkFormat.ndjson: "application/x-ndjson",
+}
+
+# (line number, validated row)
+Batch = List[Tuple[int, BaseModel]]
+# (objects to insert, (line number, error) of rejected rows)
+Prepared = Tuple[List[Tuple[int, Model]], List[Tuple[int, str]]]
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in chunks:
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def _csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Any]]:
+    """Yields (line number, dict or error) of CSV with a header, a quoted field may span lines"""
+    header: Optional[List[str]] = None
+    record: List[str] = []
+    quotes = 0
+    start = number = 0
+    async for line in lines:
+        number += 1
+        if not record:
+            if not line.strip():
+                continue
+            start = number
+        record.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        values = next(csv.reader(["".join(record)]))
+        record, quotes = [], 0
+        if header is None:
+            header = [name.strip() for name in values]
+        elif len(values) != len(header):
+            yield start, f"Expected {len(header)} columns, got {len(values)}"
+        else:
+            # Empty cells fall back to defaults
+            yield start, {name: value for name, value in zip(header, values) if value != ""}
+    if record:
+        yield start, "Unterminated quoted field"
+
+
+async def _ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Any]]:
+    """Yields (line number, dict or error) of NDJSON"""
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, "Invalid JSON"
+            continue
+        yield number, row if isinstance(row, dict) else "Row must be a JSON object"
+
+
+def _validation_error(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, item['loc'])) or 'row'}: {item['msg']}" for item in error.errors())
+
+
+async def _existing(model: Type[Model], values: set) -> set:
+    if not values:
+        return set()
+    pk = model._meta.pk_attr
+    return set(await model.filter(**{f"{pk}__in": values}).values_list(pk, flat=True))
+
+
+async def _prepare_dogs(batch: Batch) -> Prepared:
+    hosts = await _existing(User, {row.host_id for _, row in batch if row.host_id is not None})
+    objects, errors = [], []
+    for line, row in batch:
+        if row.host_id is not None and row.host_id not in hosts:
+            errors.append((line, "Host doesn't exist"))
+        else:
+            objects.append((line, Dog(**row.model_dump())))
+    return objects, errors
+
+
+async def _prepare_users(batch: Batch) -> Prepared:
+    taken = await _existing(User, {row.email for _, row in batch})
+    accepted = []
+    errors = []
+    for line, row in batch:
+        if row.email in taken:
+            errors.append((line, "User already exists"))
+        else:
+            taken.add(row.email)
+            accepted.append((line, row))
+
+    # Don't queue more hashing jobs than the hasher has workers, or it rejects them
+    plain = [row for _, row in accepted if row.hashed_password is None]
+    hashes = []
+    for start in range(0, len(plain), password_hasher.workers):
+        hashes += await asyncio.gather(*(password_hasher.hash(row.password)
+                                         for row in plain[start:start + password_hasher.workers]))
+    hashed = dict(zip((row.email for row in plain), hashes))
+
+    objects = [(line, User(**row.model_dump(exclude={"password", "hashed_password"}),
+                           hashed_password=row.hashed_password or hashed[row.email]))
+               for line, row in accepted]
+    return objects, errors
+
+
+async def _prepare_feed_requests(batch: Batch) -> Prepared:
+    actors = await _existing(User, {row.actor_id for _, row in batch})
+    targets = await _existing(Dog, {row.target_id for _, row in batch})
+    objects, errors = [], []
+    for line, row in batch:
+        if row.actor_id not in actors:
+            errors.append((line, "Actor doesn't exist"))
+        elif row.target_id not in targets:
+            errors.append((line, "Target dog doesn't exist"))
+        else:
+            objects.append((line, FeedRequest(**row.model_dump())))
+    return objects, errors
+
+
+@dataclass
+class BulkTable:
+    model: Type[Model]
+    row_model: Type[BaseModel]
+    prepare: Callable[[Batch], Awaitable[Prepared]]
+    # Exported columns, users are exported without password hashes
+    columns: Tuple[str, ...]
+    order: str
+
+
+tables: Dict[BulkKind, BulkTable] = {
+    BulkKind.dogs: BulkTable(Dog, DogImportRow, _prepare_dogs,
+                             ("id", "name", "photo", "gender", "age", "description", "feed_amount", "host_id"), "id"),
+    BulkKind.users: BulkTable(User, UserImportRow, _prepare_users,
+                              ("email", "phone", "first_name", "second_name", "is_admin", "contribution"), "email"),
+    BulkKind.feed_requests: BulkTable(FeedRequest, FeedRequestImportRow, _prepare_feed_requests,
+                                      ("id", "actor_id", "target_id", "feed_amount", "arrived_at", "approved"), "id"),
+}
+
+
+async def _insert(model: Type[Model], objects: List[Model]) -> None:
+    """Inserts objects with COPY on asyncpg and executemany elsewhere"""
+    connection = connections.get(config.primary_connection)
+    if connection.capabilities.dialect == "postgres":
+        async with connection.acquire_connection() as raw_connection:
+            if hasattr(raw_connection, "copy_records_to_table"):
+                import asyncpg
+
+                meta = model._meta
+                columns = {name: column for name, column in meta.fields_db_projection.items()
+                           if not (name == meta.pk_attr and meta.pk.generated)}
+                records = [tuple(meta.fields_map[name].to_db_value(getattr(obj, name), obj) for name in columns)
+                           for obj in objects]
+                try:
+                    await raw_connection.copy_records_to_table(meta.db_table, records=records,
+                                                               columns=list(columns.values()))
+                except asyncpg.IntegrityConstraintViolationError as error:
+                    raise IntegrityError(error)
+                return
+    await model.bulk_create(objects, using_db=connection)
+
+
+async def import_rows(kind: BulkKind, bulk_format: BulkFormat, chunks: AsyncIterator[bytes]) -> ImportResult:
+    """Parses CSV or NDJSON incrementally and inserts valid rows by batches
+
+    Invalid rows are skipped and reported with their line numbers, a batch, which violates
+    a constraint anyway (e.g. rows inserted concurrently), is reported as a whole.
+    """
+    table = tables[kind]
+    parse = _csv_rows if bulk_format == BulkFormat.csv else _ndjson_rows
+    result = ImportResult(inserted=0, failed=0, errors=[])
+
+    def fail(line: int, error: str) -> None:
+        result.failed += 1
+        if len(result.errors) < config.bulk_max_errors:
+            result.errors.append(ImportRowError(line=line, error=error))
+
+    async def flush(batch: Batch) -> None:
+        objects, errors = await table.prepare(batch)
+        for line, error in errors:
+            fail(line, error)
+        if not objects:
+            return
+        try:
+            await _insert(table.model, [obj for _, obj in objects])
+        except IntegrityError as error:
+            for line, _ in objects:
+                fail(line, str(error))
+            return
+        result.inserted += len(objects)
+        if kind == BulkKind.users:
+            for _, user in objects:
+                leaderboard.set(user.email, user.contribution)
+
+    batch: Batch = []
+    async for line, row in parse(_lines(chunks)):
+        if isinstance(row, str):
+            fail(line, row)
+            continue
+        try:
+            batch.append((line, table.row_model.model_validate(row)))
+        except ValidationError as error:
+            fail(line, _validation_error(error))
+        if len(batch) >= config.bulk_batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    if kind == BulkKind.dogs and result.inserted:
+        dog_cache.invalidate()
+    if kind in (BulkKind.dogs, BulkKind.feed_requests) and result.inserted:
+        allocator.invalidate()
+    result.errors.sort(key=lambda row_error: row_error.line)
+    return result
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+async def export_rows(kind: BulkKind, bulk_format: BulkFormat) -> AsyncIterator[bytes]:
+    """Streams the table by keyset batches, so it's never loaded at once"""
+    table = tables[kind]
+    rows = iterate_values(Keyset(table.model.all(), table.order), table.columns)
+    if bulk_format == BulkFormat.ndjson:
+        async for row in rows:
+            yield dumps({name: row[name] for name in table.columns}) + b"\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(table.columns)
+    count = 0
+    async for row in rows:
+        writer.writerow([_csv_value(row[name]) for name in table.columns])
+        count += 1
+        if count % stream_batch_size == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+import tempfile
 from datetime import timedelta
 
 
@@ -15,36 +16,212 @@ session_token_lenght: int = int(os.environ.get("SESSION_TOKEN_LENGHT", 230))
 session_max_time: timedelta = timedelta(
         days=int(os.environ.get("SESSION_TIME", 30))
 )
+# Resolved sessions are cached per worker, so keep ttl short: a logout on another worker
+# becomes visible here only after the entry expires
+session_cache_size: int = int(os.environ.get("SESSION_CACHE_SIZE", 1024))
+session_cache_ttl: float = float(os.environ.get("SESSION_CACHE_TTL", 30))
+# Other workers' contribution changes become visible in the leaderboard after this interval
+leaderboard_refresh_interval: float = float(os.environ.get("LEADERBOARD_REFRESH_INTERVAL", 60))
+# Other workers' feed requests and dog changes become visible to the donation allocator after this interval
+allocation_refresh_interval: float = float(os.environ.get("ALLOCATION_REFRESH_INTERVAL", 60))
+# Expired sessions are deleted every interval (seconds), batch by batch
+session_sweep_interval: float = float(os.environ.get("SESSION_SWEEP_INTERVAL", 3600))
+session_sweep_batch_size: int = int(os.environ.get("SESSION_SWEEP_BATCH_SIZE", 1000))
 admin_email = os.environ.get("ADMIN_USERNAME", "admin@example.com")
 admin_password = os.environ.get("ADMIN_PASSWORD", "admin")
 
 
+# Password hashing settings
+# "thread" or "process" (bcrypt releases the GIL, so threads are usually enough)
+hasher_executor: str = os.environ.get("HASHER_EXECUTOR", "thread").lower()
+hasher_workers: int = int(os.environ.get("HASHER_WORKERS", os.cpu_count() or 1))
+# How many hashing jobs may wait for a free worker before requests get 503
+hasher_queue_size: int = int(os.environ.get("HASHER_QUEUE_SIZE", 32))
+hasher_retry_after: int = int(os.environ.get("HASHER_RETRY_AFTER", 1))
+
+
+# Login and registration attempts per client IP and per email in rate_limit_window seconds,
+# buckets live in a memory-mapped file shared by workers, so limits hold across them
+rate_limit = os.environ.get("RATE_LIMIT", "True").capitalize() == str(True)
+rate_limit_path: str = os.environ.get(
+    "RATE_LIMIT_PATH", os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                    "fircode-rate-limit")
+)
+rate_limit_slots: int = int(os.environ.get("RATE_LIMIT_SLOTS", 65536))
+rate_limit_window: float = float(os.environ.get("RATE_LIMIT_WINDOW", 60))
+login_ip_limit: int = int(os.environ.get("LOGIN_IP_LIMIT", 30))
+login_email_limit: int = int(os.environ.get("LOGIN_EMAIL_LIMIT", 10))
+registration_ip_limit: int = int(os.environ.get("REGISTRATION_IP_LIMIT", 10))
+registration_email_limit: int = int(os.environ.get("REGISTRATION_EMAIL_LIMIT", 3))
+
+
+# Server settings of `poetry run start`
+server_host: str = os.environ.get("HOST", "127.0.0.1")
+server_port: int = int(os.environ.get("PORT", 8000))
+# Worker processes, each one has its own event loop, database connections and caches
+server_workers: int = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+# Every worker listens on its own SO_REUSEPORT socket, so the kernel spreads connections evenly
+# and a worker joins only after its startup (otherwise workers share the socket of the launcher)
+server_reuse_port = os.environ.get("SERVER_REUSE_PORT", "True").capitalize() == str(True)
+# "auto" picks uvloop and httptools, when they're installed
+server_loop: str = os.environ.get("SERVER_LOOP", "auto")
+server_http: str = os.environ.get("SERVER_HTTP", "auto")
+# Seconds an idle keep-alive connection is kept, keep it above the idle timeout of the proxy
+server_keep_alive: int = int(os.environ.get("SERVER_KEEP_ALIVE", 75))
+# Connections waiting to be accepted by a worker
+server_backlog: int = int(os.environ.get("SERVER_BACKLOG", 2048))
+# On SIGTERM workers stop accepting connections and finish requests in flight for up to this many seconds
+server_graceful_timeout: int = int(os.environ.get("SERVER_GRACEFUL_TIMEOUT", 30))
+# Open database connections and build serializers before a worker accepts connections
+server_warm_up = os.environ.get("SERVER_WARM_UP", "True").capitalize() == str(True)
+# Restart on code changes (development only, runs a single worker)
+server_reload = os.environ.get("SERVER_RELOAD", "False").capitalize() == str(True)
+server_proxy_headers = os.environ.get("PROXY_HEADERS", "True").capitalize() == str(True)
+forwarded_allow_ips: str = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
+ssl_keyfile = os.environ.get("SSL_KEYFILE") or None
+ssl_certfile = os.environ.get("SSL_CERTFILE") or None
+
+
+# Response cache of /api/dogs and /api/dog/{dog_id}
+dog_cache_size: int = int(os.environ.get("DOG_CACHE_SIZE", 256))
+# Bounds staleness after writes on other workers, writes on this worker drop the cache immediately
+dog_cache_ttl: float = float(os.environ.get("DOG_CACHE_TTL", 5))
+
+
+# Feed requests are buffered and inserted by batches, a submission is answered after its batch commit
+feed_write_behind = os.environ.get("FEED_WRITE_BEHIND", "False").capitalize() == str(True)
+# Buffer is flushed after this delay (milliseconds) or when it has feed_flush_size rows
+feed_flush_interval: float = float(os.environ.get("FEED_FLUSH_INTERVAL", 5))
+feed_flush_size: int = int(os.environ.get("FEED_FLUSH_SIZE", 100))
+
+
+# Server-sent events: "memory" delivers events within a worker,
+# "postgres" delivers them to every worker through LISTEN/NOTIFY
+events_backend: str = os.environ.get("EVENTS_BACKEND", "memory").lower()
+events_channel: str = os.environ.get("EVENTS_CHANNEL", "fircode_events")
+# Events queued per subscriber, a subscriber, which falls behind further, is disconnected
+events_queue_size: int = int(os.environ.get("EVENTS_QUEUE_SIZE", 256))
+# Seconds between keep-alive comments of an idle stream
+events_keepalive: float = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+
+
+# Dog photos settings
+media_directory: str = os.environ.get("MEDIA_DIR", "media")
+photo_max_size: int = int(os.environ.get("PHOTO_MAX_SIZE", 10 * 1024 * 1024))
+photo_thumbnail_size: int = int(os.environ.get("PHOTO_THUMBNAIL_SIZE", 320))
+photo_webp_max_size: int = int(os.environ.get("PHOTO_WEBP_MAX_SIZE", 1280))
+photo_webp_quality: int = int(os.environ.get("PHOTO_WEBP_QUALITY", 80))
+# Internal nginx location of media directory, photos are sent by nginx when it's set (e.g. "/protected_media")
+media_accel_redirect: str = os.environ.get("MEDIA_ACCEL_REDIRECT", "")
+
+
+# Bulk import/export settings
+# Rows inserted with one executemany (COPY on asyncpg)
+bulk_batch_size: int = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+# Import response reports at most this many row errors
+bulk_max_errors: int = int(os.environ.get("BULK_MAX_ERRORS", 1000))
+
+
+# Queries slower than this (milliseconds) are logged
+slow_query_threshold: float = float(os.environ.get("SLOW_QUERY_THRESHOLD", 100))
+
+
+# Static files settings
+# Index frontend directory on startup and serve ETags and gzip/brotli variants from memory
+static_precompute = os.environ.get("STATIC_PRECOMPUTE", "True").capitalize() == str(True)
+# Rebuild the index on frontend changes (development only, needs precompute)
+static_watch = os.environ.get("STATIC_WATCH", "False").capitalize() == str(True)
+
+
 # Database settings
 sqlite_mode = os.environ.get("USE_SQLITE", "True").capitalize() == str(True)
+sqlite_path: str = os.environ.get("SQLITE_PATH", "database.sqlite3")
+# "production": WAL with fsync at checkpoints only, memory-mapped reads and a pool of read-only connections,
+# writes are queued on the single primary connection; "default": one connection with tortoise defaults
+sqlite_profile: str = os.environ.get("SQLITE_PROFILE", "production").lower()
+sqlite_synchronous: str = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+sqlite_mmap_size: int = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+# Negative is KiB per connection
+sqlite_cache_size: int = int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024))
+# Milliseconds a connection waits for a lock of another connection or worker
+sqlite_busy_timeout: int = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+sqlite_read_connections: int = int(os.environ.get("SQLITE_READ_CONNECTIONS", 4))
 
+# Skip schema generation on startup, when models didn't change since the last one
+schema_version_check = os.environ.get("SCHEMA_VERSION_CHECK", "True").capitalize() == str(True)
+
+primary_connection = "master"
 # Ignored in sqlite mode
+db_pool_min_size: int = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+db_pool_max_size: int = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+# Comma separated read replicas: "host" or "host:port" (sqlite files in sqlite mode)
+db_replicas: list = [replica.strip() for replica in os.environ.get("DB_REPLICAS", "").split(",") if replica.strip()]
+replica_connections: list = [f"replica_{i}" for i in range(len(db_replicas))]
+# Connections to the primary database, which never write (schemas aren't generated through them)
+read_only_connections: list = []
+
+
+def _postgres_connection(host: str, port) -> dict:
+    return {
+        'engine': os.environ.get("DB_ENGINE", "tortoise.backends.asyncpg"),
+        'credentials': {
+            'host': host,
+            'port': port,
+            'user': os.environ["DB_USER"],
+            'password': os.environ["DB_PASSWORD"],
+            'database': os.environ["DB_NAME"],
+            'minsize': db_pool_min_size,
+            'maxsize': db_pool_max_size,
+        }
+    }
+
+
+def _sqlite_connection(file_path: str, read_only: bool = False) -> dict:
+    credentials = {'file_path': file_path}
+    if sqlite_profile == "production":
+        # Other credentials are applied as PRAGMAs in this order
+        credentials.update({
+            'journal_mode': 'WAL',
+            'synchronous': sqlite_synchronous,
+            'mmap_size': sqlite_mmap_size,
+            'cache_size': sqlite_cache_size,
+            'busy_timeout': sqlite_busy_timeout,
+        })
+        if read_only:
+            credentials['query_only'] = 'ON'
+    return {
+        'engine': 'tortoise.backends.sqlite',
+        'credentials': credentials,
+    }
+
+
+if sqlite_mode:
+    db_connections: dict = {primary_connection: _sqlite_connection(sqlite_path)}
+    for name, replica in zip(replica_connections, db_replicas):
+        db_connections[name] = _sqlite_connection(replica)
+    if not db_replicas and sqlite_profile == "production":
+        # WAL readers don't block the writer and each other, the router sends reads to them
+        replica_connections = read_only_connections = [f"reader_{i}" for i in range(sqlite_read_connections)]
+        for name in replica_connections:
+            db_connections[name] = _sqlite_connection(sqlite_path, read_only=True)
+else:
+    db_connections: dict = {
+        primary_connection: _postgres_connection(os.environ["DB_HOST"], os.environ.get("DB_PORT", 5432))
+    }
+    for name, replica in zip(replica_connections, db_replicas):
+        host, _, port = replica.partition(":")
+        db_connections[name] = _postgres_connection(host, port or os.environ.get("DB_PORT", 5432))
+
 tortoise_config: dict = \
 {
-    'connections': {
-        'master': {
-            'engine': os.environ.get("DB_ENGINE", "tortoise.backends.asyncpg"),
-            'credentials': {
-                'host': os.environ["DB_HOST"],
-                'port': os.environ.get("DB_PORT", 5432),
-                'user': os.environ["DB_USER"],
-                'password': os.environ["DB_PASSWORD"],
-                'database': os.environ["DB_NAME"],
-            }
-        },
-    },
+    'connections': db_connections,
     'apps': {
         'shelter': {
             'models': ['fircode.models'],
-            'default_connection': 'master',
+            'default_connection': primary_connection,
         }
     },
+    'routers': ['fircode.db_router.Router'],
     'use_tz': False,
     'timezone': 'UTC'
 }
-
-
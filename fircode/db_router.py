@@ -1,10 +1,47 @@
+import itertools
+from contextvars import ContextVar
 from typing import Type
+
+from tortoise import connections
+from tortoise.backends.base.client import BaseTransactionWrapper
 from tortoise.models import Model
 
+from fircode import config
+
+# Set after the first write of a request, so the request reads its own writes
+_primary_pinned: ContextVar[bool] = ContextVar("primary_pinned", default=False)
+_replicas = itertools.cycle(config.replica_connections)
+
+
+def pin_to_primary() -> None:
+    """Route the rest of the current request to the primary database"""
+    _primary_pinned.set(True)
+
+
+def _in_transaction() -> bool:
+    return isinstance(connections.get(config.primary_connection), BaseTransactionWrapper)
+
+
 class Router:
     def db_for_read(self, model: Type[Model]):
-        return "default"
+        if not config.replica_connections or _primary_pinned.get() or _in_transaction():
+            return config.primary_connection
+        return next(_replicas)
 
     def db_for_write(self, model: Type[Model]):
-        return "default"
+        pin_to_primary()
+        return config.primary_connection
+
+
+class ReadYourWritesMiddleware:
+    """Starts every request with reads routed to replicas"""
+
+    def __init__(self, app) -> None:
+        self.app = app
 
+    async def __call__(self, scope, receive, send) -> None:
+        token = _primary_pinned.set(False)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _primary_pinned.reset(token)
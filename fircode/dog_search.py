@@ -0,0 +1,120 @@
+import re
+from typing import Optional
+
+from fastapi.logger import logger
+from tortoise import connections
+from tortoise.exceptions import OperationalError
+from tortoise.expressions import Q, RawSQL
+from tortoise.queryset import QuerySet
+
+from fircode import config
+from fircode.models import Dog, Gender
+
+term_pattern = re.compile(r"\w+")
+# Extra terms of a query are ignored
+max_terms = 8
+
+_sqlite_schema = """
+CREATE VIRTUAL TABLE IF NOT EXISTS "dog_search" USING fts5(
+    name, description, content='dog', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS "dog_search_insert" AFTER INSERT ON "dog" BEGIN
+    INSERT INTO "dog_search" (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS "dog_search_delete" AFTER DELETE ON "dog" BEGIN
+    INSERT INTO "dog_search" ("dog_search", rowid, name, description)
+    VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS "dog_search_update" AFTER UPDATE OF name, description ON "dog" BEGIN
+    INSERT INTO "dog_search" ("dog_search", rowid, name, description)
+    VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO "dog_search" (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+"""
+_postgres_document = """to_tsvector('simple', "dog"."name" || ' ' || "dog"."description")"""
+_postgres_schema = f"""
+CREATE INDEX IF NOT EXISTS "idx_dog_search" ON "dog" USING GIN ({_postgres_document.replace('"dog".', '')});
+"""
+
+
+def schema_sql(dialect: str) -> str:
+    return _sqlite_schema if dialect == "sqlite" else _postgres_schema
+
+
+def search_terms(text: str):
+    return [term.lower() for term in term_pattern.findall(text)][:max_terms]
+
+
+class DogSearch:
+    """Prefix search over dog names and descriptions
+
+    The index lives in the database (FTS5 table kept in sync by triggers on sqlite, tsvector GIN index
+    on postgres), so writes of every worker, bulk imports included, are searchable at once.
+    """
+
+    def __init__(self) -> None:
+        self.dialect: Optional[str] = None
+        self.full_text = False
+
+    async def create_index(self) -> None:
+        """Creates the index and fills it with existing dogs (runs with schema generation)"""
+        connection = connections.get(config.primary_connection)
+        dialect = connection.capabilities.dialect
+        try:
+            await connection.execute_script(schema_sql(dialect))
+            if dialect == "sqlite":
+                await connection.execute_script("""INSERT INTO "dog_search" ("dog_search") VALUES ('rebuild')""")
+        except OperationalError as error:
+            logger.warning(f"Dog search index isn't created, search falls back to LIKE: {error}")
+
+    async def detect(self) -> None:
+        connection = connections.get(config.primary_connection)
+        self.dialect = connection.capabilities.dialect
+        if self.dialect == "sqlite":
+            rows = await connection.execute_query_dict(
+                """SELECT 1 FROM "sqlite_master" WHERE "type" = 'table' AND "name" = 'dog_search'""")
+            self.full_text = bool(rows)
+        else:
+            # The expression works without the index too, just slower
+            self.full_text = True
+
+    def match(self, queryset: QuerySet, text: str) -> QuerySet:
+        """Keeps dogs, which have words starting with every term of the text"""
+        # Terms are \w+ only, so they are safe to inline
+        terms = search_terms(text)
+        if not terms:
+            return queryset
+        if not self.full_text:
+            for term in terms:
+                queryset = queryset.filter(Q(name__icontains=term) | Q(description__icontains=term))
+            return queryset
+        if self.dialect == "sqlite":
+            query = " ".join(f'"{term}"*' for term in terms)
+            condition = f"""("dog"."id" IN (SELECT rowid FROM "dog_search" WHERE "dog_search" MATCH '{query}'))"""
+        else:
+            query = " & ".join(f"{term}:*" for term in terms)
+            condition = f"({_postgres_document} @@ to_tsquery('simple', '{query}'))"
+        return queryset.annotate(search_match=RawSQL(condition)).filter(search_match=True)
+
+    def search(self, text: Optional[str] = None, gender: Optional[Gender] = None, min_age: Optional[int] = None,
+               max_age: Optional[int] = None, hosted: Optional[bool] = None, min_feed_amount: Optional[int] = None,
+               max_feed_amount: Optional[int] = None) -> QuerySet:
+        """Returns dogs, which match every given filter"""
+        filters = {}
+        if gender is not None:
+            filters["gender"] = gender
+        if min_age is not None:
+            filters["age__gte"] = min_age
+        if max_age is not None:
+            filters["age__lte"] = max_age
+        if hosted is not None:
+            filters["host_id__isnull"] = not hosted
+        if min_feed_amount is not None:
+            filters["feed_amount__gte"] = min_feed_amount
+        if max_feed_amount is not None:
+            filters["feed_amount__lte"] = max_feed_amount
+        queryset = Dog.filter(**filters)
+        return self.match(queryset, text) if text else queryset
+
+
+dog_search = DogSearch()
@@ -0,0 +1,78 @@
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Sequence, Tuple, Type
+
+from tortoise import connections, timezone
+from tortoise.models import Model
+
+from fircode import config
+from fircode.models import DailyDonations, Donation, DogDonations, UserDonations
+
+
+def _upsert_sql(model: Type[Model], columns: Sequence[str], rows: int, dialect: str) -> str:
+    """INSERT of rows, which adds the values to an existing row with the same primary key instead"""
+    table = model._meta.db_table
+    key = model._meta.pk.source_field or model._meta.pk_attr
+    width = 1 + len(columns)
+    if dialect == "postgres":
+        placeholders = [f"${index + 1}" for index in range(rows * width)]
+    else:
+        placeholders = ["?"] * (rows * width)
+    values = ", ".join("(" + ", ".join(placeholders[row * width:(row + 1) * width]) + ")" for row in range(rows))
+    names = ", ".join(f'"{column}"' for column in (key, *columns))
+    increments = ", ".join(f'"{column}" = "{table}"."{column}" + excluded."{column}"' for column in columns)
+    return f'INSERT INTO "{table}" ({names}) VALUES {values} ON CONFLICT ("{key}") DO UPDATE SET {increments}'
+
+
+async def _add_to_rollup(model: Type[Model], columns: Sequence[str], totals: Dict[object, List[int]]) -> None:
+    connection = connections.get(config.primary_connection)
+    # Sorted keys, so concurrent approvals lock rows in the same order
+    keys = sorted(totals)
+    values = [value for key in keys for value in (key, *totals[key])]
+    await connection.execute_query(_upsert_sql(model, columns, len(keys), connection.capabilities.dialect), values)
+
+
+async def record_donations(approved: List[dict]) -> None:
+    """Appends approved feed requests to the ledger and adds them to the rollups
+
+    Call it inside the approval transaction, rows are dicts with id, actor_id, target_id, feed_amount,
+    arrived_at and award. Each rollup costs one statement, whatever the number of rows is.
+    """
+    if not approved:
+        return
+    today = timezone.now().date()
+    await Donation.bulk_create([
+        Donation(feed_request_id=row["id"], actor_id=row["actor_id"], dog_id=row["target_id"],
+                 feed_amount=row["feed_amount"], award=row["award"], arrived_at=row["arrived_at"])
+        for row in approved
+    ], using_db=connections.get(config.primary_connection))
+
+    daily: Dict[date, List[int]] = {today: [0, 0]}
+    by_dog: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
+    by_user: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])
+    for row in approved:
+        for totals in (daily[today], by_dog[row["target_id"]], by_user[row["actor_id"]]):
+            totals[0] += row["feed_amount"]
+            totals[1] += 1
+        by_user[row["actor_id"]][2] += row["award"]
+    await _add_to_rollup(DailyDonations, ("feed_amount", "donations"), daily)
+    await _add_to_rollup(DogDonations, ("feed_amount", "donations"), by_dog)
+    await _add_to_rollup(UserDonations, ("feed_amount", "donations", "award"), by_user)
+
+
+async def daily_totals(since: date, until: date) -> List[dict]:
+    """Returns rollup rows of days with donations, the cost depends on the range only"""
+    return await DailyDonations.filter(day__gte=since, day__lte=until).order_by("day") \
+        .values("day", "feed_amount", "donations")
+
+
+async def dog_totals(dog_id: int) -> Tuple[int, int]:
+    """Returns feed amount and number of donations of the dog"""
+    rows = await DogDonations.filter(dog_id=dog_id).values_list("feed_amount", "donations")
+    return rows[0] if rows else (0, 0)
+
+
+async def user_totals(email: str) -> Tuple[int, int, int]:
+    """Returns feed amount, number of donations and award of the donor"""
+    rows = await UserDonations.filter(actor_id=email).values_list("feed_amount", "donations", "award")
+    return rows[0] if rows else (0, 0, 0)
@@ -0,0 +1,178 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Iterable, List, Optional, Set, Tuple
+
+from fastapi.logger import logger
+from tortoise import connections
+
+from fircode import config
+from fircode.serialization import dumps
+
+
+class Subscription:
+    def __init__(self, topics: Optional[Set[str]], queue_size: int, email: str, is_admin: bool) -> None:
+        # None means every topic
+        self.topics = topics
+        self.email = email
+        self.is_admin = is_admin
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def close(self) -> None:
+        """Ends the stream after the events, which are already queued"""
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self.overflow()
+
+    def overflow(self) -> None:
+        """Drops queued events and ends the stream, the client reconnects and reloads the state"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class MemoryBackend:
+    """Delivers events to subscribers of this worker only"""
+
+    async def start(self, deliver: Callable[[str], None]) -> None:
+        self.deliver = deliver
+
+    async def publish(self, messages: List[str]) -> None:
+        for message in messages:
+            self.deliver(message)
+
+    async def stop(self) -> None:
+        pass
+
+
+class PostgresBackend:
+    """Delivers events to subscribers of every worker through LISTEN/NOTIFY"""
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+        self._listener = None
+
+    async def start(self, deliver: Callable[[str], None]) -> None:
+        import asyncpg
+
+        credentials = config.db_connections[config.primary_connection]["credentials"]
+        # LISTEN holds its connection, so it doesn't take one from the pool
+        self._listener = await asyncpg.connect(host=credentials["host"], port=credentials["port"],
+                                               user=credentials["user"], password=credentials["password"],
+                                               database=credentials["database"])
+        await self._listener.add_listener(self.channel, lambda connection, pid, channel, payload: deliver(payload))
+
+    async def publish(self, messages: List[str]) -> None:
+        await connections.get(config.primary_connection).execute_query(
+            "SELECT pg_notify($1, message) FROM unnest($2::text[]) AS message", [self.channel, messages])
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+
+class EventHub:
+    """Publishes dog and feed request changes to server-sent events subscribers
+
+    An event is encoded once and shared by every subscriber. A subscriber, which doesn't keep up,
+    is disconnected instead of buffering events without a bound. An event with an audience (a user's email)
+    is delivered to that user and admins only.
+    """
+
+    def __init__(self, backend, queue_size: int, keepalive: float) -> None:
+        self.backend = backend
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.subscriptions: Set[Subscription] = set()
+        self.published = 0
+        self.delivered = 0
+        self.overflowed = 0
+
+    async def start(self) -> None:
+        await self.backend.start(self.deliver)
+
+    async def stop(self) -> None:
+        self.close_streams()
+        await self.backend.stop()
+
+    def close_streams(self) -> None:
+        """Ends every stream, so a stopping worker doesn't wait for them (clients reconnect to another one)"""
+        for subscription in self.subscriptions:
+            subscription.close()
+        self.subscriptions.clear()
+
+    async def publish(self, event: str, data: Any, audience: Optional[str] = None) -> None:
+        """Sends an event, its topic is the part of the name before the dot ("dog.updated" -> "dog")
+
+        Events with personal data are sent with an audience: the email of the user, who may see them besides admins.
+        """
+        await self.publish_many([(event, data, audience)])
+
+    async def publish_many(self, events: List[Tuple[str, Any, Optional[str]]]) -> None:
+        """Sends (event, data, audience) with a single NOTIFY query"""
+        if not events:
+            return
+        self.published += len(events)
+        try:
+            await self.backend.publish([f"{event}\n{audience or ''}\n{dumps(data).decode('utf-8')}"
+                                        for event, data, audience in events])
+        except Exception:
+            logger.exception(f"Events aren't published: {', '.join(event for event, _, _ in events)}")
+
+    def deliver(self, message: str) -> None:
+        event, audience, data = message.split("\n", 2)
+        topic = event.split(".", 1)[0]
+        frame = f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+        for subscription in list(self.subscriptions):
+            if subscription.topics is not None and topic not in subscription.topics:
+                continue
+            if audience and not subscription.is_admin and subscription.email != audience:
+                continue
+            try:
+                subscription.queue.put_nowait(frame)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                self.overflowed += 1
+                self.subscriptions.discard(subscription)
+                subscription.overflow()
+
+    def subscribe(self, email: str, is_admin: bool, topics: Optional[Iterable[str]] = None) -> Subscription:
+        subscription = Subscription(set(topics) if topics else None, self.queue_size, email, is_admin)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    async def stream(self, subscription: Subscription) -> AsyncIterator[bytes]:
+        """Yields server-sent events frames of the subscription with keep-alive comments"""
+        try:
+            yield b": connected\n\n"
+            while True:
+                try:
+                    frame = await asyncio.wait_for(subscription.queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self.subscriptions.discard(subscription)
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "subscribers": len(self.subscriptions),
+            "published": self.published,
+            "delivered": self.delivered,
+            "overflowed": self.overflowed,
+        }
+
+
+def _backend():
+    if config.events_backend == "postgres":
+        if not config.sqlite_mode:
+            return PostgresBackend(config.events_channel)
+        logger.warning("Postgres events backend needs postgres, events are delivered within a worker")
+    return MemoryBackend()
+
+
+event_hub = EventHub(_backend(), queue_size=config.events_queue_size, keepalive=config.events_keepalive)
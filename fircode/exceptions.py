@@ -4,3 +4,25 @@ class UserAlreadyExists(Exception):
 
 class UsernameOrPasswordWrong(Exception):
     pass
+
+
+class HasherOverloaded(Exception):
+    pass
+
+
+class PhotoTooLarge(Exception):
+    pass
+
+
+class PhotoNotImage(Exception):
+    pass
+
+
+class PermissionDenied(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
@@ -0,0 +1,244 @@
+import asyncio
+import uuid
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from tortoise import connections
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+
+from fircode import config
+from fircode.allocation import allocator
+from fircode.donations import record_donations
+from fircode.events import event_hub
+from fircode.leaderboard import leaderboard
+from fircode.models import Dog, FeedRequest, FeedRequestApproveRequest, FeedRequestsApproveResult, User
+from fircode.response_cache import dog_cache
+
+
+def _group_by_delta(deltas: Dict) -> Dict[int, List]:
+    """Groups keys by their delta, so every group is updated with a single query"""
+    groups = defaultdict(list)
+    for key, delta in deltas.items():
+        if delta:
+            groups[delta].append(key)
+    return groups
+
+
+async def process_feed_requests(decisions: Iterable[FeedRequestApproveRequest]) -> FeedRequestsApproveResult:
+    """Approve or decline feed requests in a single transaction
+
+    Contribution and feed amount deltas are summed per user and per dog and applied with
+    F-expressions, so concurrent approvals can't overwrite each other. Approved ones are appended
+    to the donation ledger before they're deleted.
+    """
+    decisions = {decision.id: decision for decision in decisions}
+    awards: Dict[str, int] = defaultdict(int)
+    feed_amounts: Dict[int, int] = defaultdict(int)
+    approved = declined = 0
+    async with in_transaction(config.primary_connection):
+        rows = await FeedRequest.filter(id__in=list(decisions)).select_for_update() \
+            .values("id", "actor_id", "target_id", "feed_amount", "arrived_at")
+        for row in rows:
+            decision = decisions[row["id"]]
+            if decision.approved:
+                approved += 1
+                awards[row["actor_id"]] += decision.award
+                feed_amounts[row["target_id"]] += row["feed_amount"]
+            else:
+                declined += 1
+        for award, emails in _group_by_delta(awards).items():
+            await User.filter(email__in=emails).update(contribution=F("contribution") + award)
+        for feed_amount, dog_ids in _group_by_delta(feed_amounts).items():
+            await Dog.filter(id__in=dog_ids).update(feed_amount=F("feed_amount") + feed_amount)
+        if rows:
+            await FeedRequest.filter(id__in=[row["id"] for row in rows]).delete()
+        await record_donations([{**row, "award": decisions[row["id"]].award}
+                                for row in rows if decisions[row["id"]].approved])
+        dogs = await Dog.filter(id__in=list(feed_amounts)).values("id", "feed_amount") if feed_amounts else []
+
+    if approved:
+        # Both feed amount and host contribution are part of DogOut
+        dog_cache.invalidate()
+    for email, award in awards.items():
+        leaderboard.add(email, award)
+    for row in rows:
+        if decisions[row["id"]].approved:
+            allocator.approve(row["target_id"], row["feed_amount"])
+        else:
+            allocator.add_pending(row["target_id"], -row["feed_amount"])
+    await event_hub.publish_many(
+        [("feed_request.approved" if decisions[row["id"]].approved else "feed_request.declined", {"id": row["id"]},
+          row["actor_id"]) for row in rows] + [("dog.updated", dog, None) for dog in dogs]
+    )
+    found = {row["id"] for row in rows}
+    return FeedRequestsApproveResult(
+        approved=approved,
+        declined=declined,
+        missing=[request_id for request_id in decisions if request_id not in found]
+    )
+
+
+def feed_request_out(feed_request: FeedRequest) -> dict:
+    return {
+        "approved": feed_request.approved,
+        "feed_amount": feed_request.feed_amount,
+        "arrived_at": feed_request.arrived_at,
+        "target_id": feed_request.target_id,
+        "actor_id": feed_request.actor_id,
+        "id": feed_request.id,
+    }
+
+
+class FeedRequestWriter:
+    """Inserts submitted feed requests by batches (write-behind)
+
+    A submission waits for the commit of its batch, so a response still means the feed request is stored.
+    Feed requests with the same idempotency key of the same user are stored once.
+    """
+
+    def __init__(self, enabled: bool, batch_size: int, interval: float) -> None:
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._pending: List[Tuple[FeedRequest, asyncio.Future]] = []
+        # (actor, idempotency key) -> future of a feed request, which isn't stored yet
+        self._keys: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.inserted = 0
+        self.deduplicated = 0
+
+    async def submit(self, actor_id: str, target_id: int, feed_amount: int, arrived_at: date,
+                     idempotency_key: Optional[str] = None) -> FeedRequest:
+        """Stores a feed request or returns the stored one with the same idempotency key"""
+        if idempotency_key is not None:
+            existing = await FeedRequest.get_or_none(actor_id=actor_id, idempotency_key=idempotency_key)
+            if existing is not None:
+                self.deduplicated += 1
+                return existing
+            future = self._keys.get((actor_id, idempotency_key))
+            if future is not None:
+                self.deduplicated += 1
+                return await asyncio.shield(future)
+
+        feed_request = FeedRequest(actor_id=actor_id, target_id=target_id, feed_amount=feed_amount,
+                                   arrived_at=arrived_at, idempotency_key=idempotency_key or uuid.uuid4().hex)
+        future = asyncio.get_running_loop().create_future()
+        self._keys[(actor_id, feed_request.idempotency_key)] = future
+        if not self.enabled:
+            await self._write([(feed_request, future)])
+            return future.result()
+
+        self._pending.append((feed_request, future))
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        # Cancelled submission doesn't cancel the write of the whole batch
+        return await asyncio.shield(future)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.interval / 1000)
+        self._timer = None
+        self._start_flush()
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: List[Tuple[FeedRequest, asyncio.Future]]) -> None:
+        try:
+            feed_requests = [feed_request for feed_request, _ in batch]
+            try:
+                await self._insert(feed_requests)
+            except IntegrityError:
+                # A duplicate key from another worker or a deleted dog, sort it out row by row
+                for feed_request, future in batch:
+                    try:
+                        future.set_result(await self._insert_one(feed_request))
+                    except IntegrityError as error:
+                        future.set_exception(error)
+            else:
+                for feed_request, future in batch:
+                    future.set_result(feed_request)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            for feed_request, future in batch:
+                self._keys.pop((feed_request.actor_id, feed_request.idempotency_key), None)
+                # Nobody may wait for a future of a cancelled request
+                if future.done() and not future.cancelled():
+                    future.exception()
+
+    async def _insert(self, feed_requests: List[FeedRequest]) -> None:
+        """Inserts the batch with one multi-row insert in a single transaction"""
+        if len(feed_requests) == 1:
+            await feed_requests[0].save()
+            self.batches += 1
+            self.inserted += 1
+            allocator.add_pending(feed_requests[0].target_id, feed_requests[0].feed_amount)
+            await event_hub.publish("feed_request.created", feed_request_out(feed_requests[0]),
+                                    audience=feed_requests[0].actor_id)
+            return
+        async with in_transaction(config.primary_connection) as connection:
+            await FeedRequest.bulk_create(feed_requests, using_db=connection)
+            rows = await FeedRequest.filter(
+                idempotency_key__in=[feed_request.idempotency_key for feed_request in feed_requests]
+            ).using_db(connection).values_list("actor_id", "idempotency_key", "id")
+        ids = {(actor_id, idempotency_key): request_id for actor_id, idempotency_key, request_id in rows}
+        for feed_request in feed_requests:
+            feed_request.id = ids[(feed_request.actor_id, feed_request.idempotency_key)]
+        self.batches += 1
+        self.inserted += len(feed_requests)
+        for feed_request in feed_requests:
+            allocator.add_pending(feed_request.target_id, feed_request.feed_amount)
+        await event_hub.publish_many([("feed_request.created", feed_request_out(feed_request), feed_request.actor_id)
+                                      for feed_request in feed_requests])
+
+    async def _insert_one(self, feed_request: FeedRequest) -> FeedRequest:
+        try:
+            await self._insert([feed_request])
+            return feed_request
+        except IntegrityError:
+            existing = await FeedRequest.filter(actor_id=feed_request.actor_id,
+                                                idempotency_key=feed_request.idempotency_key) \
+                .using_db(connections.get(config.primary_connection)).first()
+            if existing is None:
+                raise
+            self.deduplicated += 1
+            return existing
+
+    async def close(self) -> None:
+        """Writes buffered feed requests (call it on shutdown)"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "inserted": self.inserted,
+            "deduplicated": self.deduplicated,
+            "avg_batch_size": self.inserted / self.batches if self.batches else 0.0,
+        }
+
+
+feed_request_writer = FeedRequestWriter(
+    enabled=config.feed_write_behind,
+    batch_size=config.feed_flush_size,
+    interval=config.feed_flush_interval
+)
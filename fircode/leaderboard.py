@@ -0,0 +1,81 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fircode import config
+from fircode.models import User
+from fircode.sorted_keys import SortedKeys
+
+
+class Leaderboard:
+    """Users sorted by contribution, updated in place when contribution changes
+
+    Keys are (-contribution, email), so they're sorted from the best user to the worst one.
+    An update and a rank lookup take O(log n).
+    """
+
+    def __init__(self, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self._keys = SortedKeys()
+        self._contributions: Dict[str, int] = {}
+        self._built_at: Optional[float] = None
+
+    def load(self, rows: List[Tuple[str, int]]) -> None:
+        self._contributions = dict(rows)
+        self._keys = SortedKeys((-contribution, email) for email, contribution in rows)
+        self._built_at = time.monotonic()
+
+    async def rebuild(self) -> None:
+        """Load contributions of all users from the database"""
+        self.load(await User.all().values_list("email", "contribution"))
+
+    async def ensure_fresh(self) -> None:
+        """Rebuild the leaderboard, if other workers could change the database since the last build"""
+        if self._built_at is None or time.monotonic() - self._built_at > self.refresh_interval:
+            await self.rebuild()
+
+    def set(self, email: str, contribution: int) -> None:
+        self.remove(email)
+        self._contributions[email] = contribution
+        self._keys.add((-contribution, email))
+
+    def add(self, email: str, award: int) -> None:
+        self.set(email, self._contributions.get(email, 0) + award)
+
+    def remove(self, email: str) -> None:
+        contribution = self._contributions.pop(email, None)
+        if contribution is not None:
+            self._keys.remove((-contribution, email))
+
+    def contribution(self, email: str) -> Optional[int]:
+        return self._contributions.get(email)
+
+    def rank(self, email: str) -> Optional[int]:
+        """Returns 1-based rank of the user, users with equal contribution share a rank"""
+        contribution = self._contributions.get(email)
+        if contribution is None:
+            return None
+        return self._keys.bisect_left((-contribution, "")) + 1
+
+    def top(self, limit: int) -> List[Tuple[int, str, int]]:
+        """Returns (rank, email, contribution) of the best users"""
+        return self._entries(0, limit)
+
+    def around(self, email: str, radius: int) -> List[Tuple[int, str, int]]:
+        """Returns (rank, email, contribution) of users next to the user"""
+        contribution = self._contributions.get(email)
+        if contribution is None:
+            return []
+        index = self._keys.bisect_left((-contribution, email))
+        return self._entries(max(0, index - radius), index + radius + 1)
+
+    def _entries(self, start: int, stop: int) -> List[Tuple[int, str, int]]:
+        entries = []
+        for negative_contribution, email in self._keys[start:stop]:
+            entries.append((self._keys.bisect_left((negative_contribution, "")) + 1, email, -negative_contribution))
+        return entries
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+leaderboard = Leaderboard(refresh_interval=config.leaderboard_refresh_interval)
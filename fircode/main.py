@@ -1,28 +1,47 @@
-from typing import List
+import math
+from datetime import date, timedelta
+from typing import List, Optional
 
-import uvicorn
-from fastapi import FastAPI
-from fastapi import Request
+from fastapi import BackgroundTasks, Depends, FastAPI
+from fastapi import Header, Query, Request, Response
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from tortoise.exceptions import DoesNotExist
-from tortoise.transactions import in_transaction
+from tortoise.exceptions import DoesNotExist, IntegrityError
 
 from fircode import config
-from fircode.exceptions import UserAlreadyExists
+from fircode import bulk
+from fircode import donations
+from fircode import photos
+from fircode import server
+from fircode.allocation import allocator
+from fircode.db_router import ReadYourWritesMiddleware, pin_to_primary
+from fircode.dog_search import dog_search
+from fircode.events import event_hub
+from fircode.exceptions import UserAlreadyExists, HasherOverloaded, PermissionDenied, PhotoNotImage, PhotoTooLarge, \
+    RateLimited
+from fircode.feed_requests import feed_request_out, feed_request_writer, process_feed_requests
+from fircode.leaderboard import leaderboard
+from fircode.metrics import MetricsMiddleware, exposition, instrument, timed
 from fircode.models import *
-from fircode.session import Session, session_responses
+from fircode.pagination import fetch_list, list_response, next_cursor_header
+from fircode.password_hasher import password_hasher
+from fircode.rate_limit import login_rate_limit, rate_limiter, registration_rate_limit
+from fircode.response_cache import dog_cache
+from fircode.serialization import FastJSONResponse, dumps, from_queryset_single, project
+from fircode.session import AdminUser, CurrentUser, Session, invalidate_user_sessions, session_responses, \
+    session_cache, start_sweeper, stop_sweeper
 from fircode.spa_static_files import SinglePageApplication
-from fircode.startup import initialize_database, database_setup
+from fircode.startup import initialize_database, database_setup, time_startup, warm_up
 from fircode.user_utils import create_user
 
 app: FastAPI = FastAPI(title="root app")
-api_app: FastAPI = FastAPI(title="api app")
+api_app: FastAPI = FastAPI(title="api app", default_response_class=FastJSONResponse)
 
 app.mount("/api", api_app)
-app.mount("/", app=SinglePageApplication(directory="frontend"), name="static")
+spa = SinglePageApplication(directory="frontend", precompute=config.static_precompute)
+app.mount("/", app=spa, name="static")
 templates = Jinja2Templates(directory="frontend")
 
 if config.debug:
@@ -39,13 +58,88 @@ if config.debug:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=[next_cursor_header],
     )
 
+api_app.add_middleware(ReadYourWritesMiddleware)
+api_app.add_middleware(MetricsMiddleware)
+
 initialize_database(app)
+app.router.on_startup.append(instrument)
 app.router.on_startup.append(database_setup)
+app.router.on_startup.append(leaderboard.rebuild)
+app.router.on_startup.append(allocator.rebuild)
+app.router.on_startup.append(start_sweeper)
+app.router.on_startup.append(event_hub.start)
+app.router.on_shutdown.append(event_hub.stop)
+app.router.on_shutdown.append(stop_sweeper)
+app.router.on_shutdown.append(feed_request_writer.close)
+app.router.on_shutdown.append(password_hasher.shutdown)
+if config.static_precompute and config.static_watch:
+    app.router.on_startup.append(spa.start_watching)
+if config.server_warm_up:
+    app.router.on_startup.append(warm_up)
+time_startup(app)
+
+
+@api_app.exception_handler(HasherOverloaded)
+async def hasher_overloaded_handler(request: Request, exc: HasherOverloaded):
+    return JSONResponse(
+        status_code=503,
+        content="Server is busy, try again later",
+        headers={"Retry-After": str(config.hasher_retry_after)}
+    )
+
+
+@api_app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=429,
+        content="Too many attempts, try again later",
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
+
+
+@api_app.exception_handler(PermissionDenied)
+async def permission_denied_handler(request: Request, exc: PermissionDenied):
+    return JSONResponse(status_code=405, content="You doesn't have permissions to do this")
+
+
+@api_app.get("/hasher_stats", responses={**session_responses, 405: {"Method not allowed": {}}})
+async def get_hasher_stats(user: AdminUser):
+    """Provide password hashing pool depth and latency (admin only)"""
+    return password_hasher.stats()
+
+
+@api_app.get("/session_cache_stats", responses={**session_responses, 405: {"Method not allowed": {}}})
+async def get_session_cache_stats(user: AdminUser):
+    """Provide session cache size and hit/miss counters (admin only)"""
+    return session_cache.stats()
+
+
+@api_app.get("/dog_cache_stats", responses={**session_responses, 405: {"Method not allowed": {}}})
+async def get_dog_cache_stats(user: AdminUser):
+    """Provide dog response cache version and hit/miss counters (admin only)"""
+    return dog_cache.stats()
+
+
+@api_app.get("/metrics", response_class=PlainTextResponse,
+             responses={**session_responses, 405: {"Method not allowed": {}}})
+async def get_metrics(user: AdminUser):
+    """Provide metrics of this worker in Prometheus text format (admin only)"""
+    return PlainTextResponse(exposition({
+        "fircode_hasher": password_hasher.stats(),
+        "fircode_session_cache": session_cache.stats(),
+        "fircode_dog_cache": dog_cache.stats(),
+        "fircode_feed_writer": feed_request_writer.stats(),
+        "fircode_events": event_hub.stats(),
+        "fircode_rate_limit": rate_limiter.stats(),
+    }), media_type="text/plain; version=0.0.4")
 
 
-@api_app.post("/registration")
+@api_app.post("/registration", dependencies=[Depends(registration_rate_limit)],
+              responses={429: {"description": "Too many attempts from this IP or for this email"},
+                         503: {"description": "Password hashing pool is saturated"}})
 async def user_registration(new_user: UserRegistrationRequest):
     """Provide user registration"""
     try:
@@ -64,25 +158,104 @@ async def user_registration(new_user: UserRegistrationRequest):
         )
 
 
-@api_app.post("/login", responses=session_responses)
+@api_app.post("/login", dependencies=[Depends(login_rate_limit)],
+              responses={**session_responses, 429: {"description": "Too many attempts from this IP or for this email"},
+                         503: {"description": "Password hashing pool is saturated"}})
 async def login(request: SignInRequest):
     """Login into user account via password and email"""
     return await Session().create_session(request)
 
 
 @api_app.get("/user", responses=session_responses, response_model=UserResponse)
-async def current_user(request: Request):
+async def current_user(user: CurrentUser):
     """Provide information about current user"""
-    session = Session()
-    await session.get_from_request(request)
-    return session.user
+    users = await project(UserResponse, User.filter(email=user.email))
+    if not users:
+        # Deleted, while its session was still cached
+        invalidate_user_sessions(user.email)
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return users[0]
 
 
-@api_app.get("/users_stat", response_model=List[UserResponseForStat])
-async def get_users_stat():
+list_responses = {200: {"content": {"application/x-ndjson": {}},
+                         "description": f"Page of rows, the next page cursor is in {next_cursor_header} header"}}
+
+
+@api_app.get("/users_stat", response_model=List[UserResponseForStat], responses=list_responses)
+async def get_users_stat(limit: Optional[int] = Query(None, ge=1, le=1000),
+                         cursor: Optional[str] = None, stream: bool = False):
     """Provide information about users"""
     """Exclude fields email, phone and is_admin from response"""
-    return await UserResponseForStat.from_queryset(User.all().order_by("-contribution"))
+    return await list_response(UserResponseForStat, User.all(), "-contribution", limit, cursor, stream)
+
+
+async def leaderboard_entries(entries: List[tuple]) -> List[LeaderboardEntry]:
+    names = {row["email"]: row for row in
+             await User.filter(email__in=[email for _, email, _ in entries]).values("email", "first_name",
+                                                                                     "second_name")}
+    return [LeaderboardEntry(rank=rank, contribution=contribution, first_name=names[email]["first_name"],
+                             second_name=names[email]["second_name"])
+            for rank, email, contribution in entries if email in names]
+
+
+@api_app.get("/users_stat/top", response_model=List[LeaderboardEntry])
+async def get_users_top(limit: int = Query(10, ge=1, le=100)):
+    """Provide the best users by contribution"""
+    await leaderboard.ensure_fresh()
+    return await leaderboard_entries(leaderboard.top(limit))
+
+
+@api_app.get("/users_stat/me", responses=session_responses, response_model=LeaderboardPosition)
+async def get_user_rank(user: CurrentUser):
+    """Provide rank of the current user"""
+    await leaderboard.ensure_fresh()
+    rank = leaderboard.rank(user.email)
+    if rank is None:
+        return JSONResponse(status_code=404, content="You aren't in the leaderboard yet")
+    return LeaderboardPosition(rank=rank, contribution=leaderboard.contribution(user.email),
+                               total=len(leaderboard))
+
+
+@api_app.get("/users_stat/around_me", responses=session_responses, response_model=List[LeaderboardEntry])
+async def get_users_around(user: CurrentUser, radius: int = Query(5, ge=0, le=50)):
+    """Provide users next to the current user in the leaderboard"""
+    await leaderboard.ensure_fresh()
+    return await leaderboard_entries(leaderboard.around(user.email, radius))
+
+
+@api_app.get("/stats/daily", responses={**session_responses, 405: {"Method not allowed": {}}},
+             response_model=List[DailyDonationTotals])
+async def get_daily_donations(user: AdminUser, since: Optional[date] = None, until: Optional[date] = None):
+    """Provide approved donations per day, 30 days till today by default (admin only)
+
+    Days without donations are omitted, at most 366 days are returned.
+    """
+    until = until or date.today()
+    since = max(since or until - timedelta(days=29), until - timedelta(days=365))
+    return await donations.daily_totals(since, until)
+
+
+@api_app.get("/stats/dogs/{dog_id}", responses={**session_responses, 405: {"Method not allowed": {}}},
+             response_model=DonationTotals)
+async def get_dog_donations(user: AdminUser, dog_id: int):
+    """Provide approved donations to the dog over all time (admin only)"""
+    feed_amount, count = await donations.dog_totals(dog_id)
+    return DonationTotals(feed_amount=feed_amount, donations=count)
+
+
+@api_app.get("/stats/users/me", responses=session_responses, response_model=UserDonationTotals)
+async def get_my_donations(user: CurrentUser):
+    """Provide approved donations of the current user over all time"""
+    feed_amount, count, award = await donations.user_totals(user.email)
+    return UserDonationTotals(feed_amount=feed_amount, donations=count, award=award)
+
+
+@api_app.get("/stats/users/{email}", responses={**session_responses, 405: {"Method not allowed": {}}},
+             response_model=UserDonationTotals)
+async def get_user_donations(user: AdminUser, email: str):
+    """Provide approved donations of the user over all time (admin only)"""
+    feed_amount, count, award = await donations.user_totals(email)
+    return UserDonationTotals(feed_amount=feed_amount, donations=count, award=award)
 
 
 @api_app.post("/logout")
@@ -91,131 +264,247 @@ async def logout(request: Request):
     return await Session().close_session(request)
 
 
-@api_app.get("/dogs", response_model=List[DogOut])
-async def get_all_dogs():
+@api_app.get("/dogs", response_model=List[DogOut], responses=list_responses)
+async def get_all_dogs(request: Request, limit: Optional[int] = Query(None, ge=1, le=1000),
+                       cursor: Optional[str] = None, stream: bool = False):
     """Provide list of all dogs"""
-    return await DogOut.from_queryset(Dog.all().order_by("feed_amount"))
+    if stream:
+        return await list_response(DogOut, Dog.all(), "feed_amount", limit, cursor, stream)
+
+    async def build():
+        dogs, next_cursor = await fetch_list(DogOut, Dog.all(), "feed_amount", limit, cursor)
+        with timed("serialize"):
+            body = dumps(dogs)
+        return body, {next_cursor_header: next_cursor} if next_cursor else {}
+
+    return await dog_cache.respond(request, ("dogs", limit, cursor), build)
+
+
+@api_app.get("/dogs/search", response_model=List[DogOut], responses=list_responses)
+async def search_dogs(request: Request, q: Optional[str] = Query(None, max_length=256),
+                      gender: Optional[Gender] = None, min_age: Optional[int] = None, max_age: Optional[int] = None,
+                      host: Optional[bool] = None, min_feed_amount: Optional[int] = None,
+                      max_feed_amount: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=1000),
+                      cursor: Optional[str] = None, stream: bool = False):
+    """Find dogs by words of name or description (prefix match), gender, age, host and feed amount"""
+    queryset = dog_search.search(q, gender, min_age, max_age, host, min_feed_amount, max_feed_amount)
+    if stream:
+        return await list_response(DogOut, queryset, "feed_amount", limit, cursor, stream)
+
+    async def build():
+        dogs, next_cursor = await fetch_list(DogOut, queryset, "feed_amount", limit, cursor)
+        with timed("serialize"):
+            body = dumps(dogs)
+        return body, {next_cursor_header: next_cursor} if next_cursor else {}
+
+    key = ("search", q, gender, min_age, max_age, host, min_feed_amount, max_feed_amount, limit, cursor)
+    return await dog_cache.respond(request, key, build)
+
+
+@api_app.get("/dogs/allocation", response_model=List[DogAllocation])
+async def allocate_donation(units: int = Query(..., ge=1, le=1_000_000), max_dogs: int = Query(5, ge=1, le=50)):
+    """Suggest how to split a donation of units among the hungriest dogs
+
+    Dogs are ranked by feed amount plus pending feed requests, a donation raises the hungriest ones
+    to a common level, so large donations are spread among several dogs.
+    """
+    await allocator.ensure_fresh()
+    allocation = allocator.allocate(units, max_dogs)
+    names = dict(await Dog.filter(id__in=[dog_id for dog_id, _ in allocation]).values_list("id", "name"))
+    return [DogAllocation(dog_id=dog_id, name=names[dog_id], units=share, feed_amount=allocator.level(dog_id)[0],
+                          pending=allocator.level(dog_id)[1])
+            for dog_id, share in allocation if dog_id in names]
+
+
+@api_app.get("/dog/{dog_id}", response_model=DogOut)
+async def get_dog_by_id(request: Request, dog_id: int):
+    """Provide full information about dog by id"""
 
+    async def build():
+        dogs = await project(DogOut, Dog.filter(id=dog_id))
+        if not dogs:
+            raise DoesNotExist
+        with timed("serialize"):
+            return dumps(dogs[0]), {}
 
-@api_app.get("/dog/{dog_id}")
-async def get_dog_by_id(dog_id: int):
-    """Provide full information about dog by id"""
     try:
-        return await DogOut.from_queryset_single(Dog.get(id=dog_id))
+        return await dog_cache.respond(request, ("dog", dog_id), build)
     except DoesNotExist:
         return JSONResponse(status_code=404, content="Dog with this id doesn't exist")
 
 
 @api_app.post("/dog", responses={**session_responses, 405: {"Method not allowed": {}}})
-async def add_dog(request: Request, new_dog: DogIn):
+async def add_dog(user: AdminUser, new_dog: DogIn):
     """Add dog"""
-    session = Session()
-    await session.get_from_request(request)
-    if session.user.is_admin:
-        if new_dog.gender in ("male", "female"):
-            dog = await Dog.create(**new_dog.dict(exclude_unset=True))
-            return dog
-        else:
-            return JSONResponse(status_code=422, content="Gender isn't valid")
+    if new_dog.gender in ("male", "female"):
+        dog = await Dog.create(**new_dog.dict(exclude_unset=True))
+        dog_cache.invalidate()
+        allocator.set_feed_amount(dog.id, dog.feed_amount)
+        await event_hub.publish("dog.created", (await project(DogOut, Dog.filter(id=dog.id)))[0])
+        return dog
     else:
-        return JSONResponse(status_code=405, content="You doesn't have permissions to add dog")
+        return JSONResponse(status_code=422, content="Gender isn't valid")
 
 
 @api_app.put("/dog", responses={**session_responses, 405: {"Method not allowed": {}}})
-async def update_dog(request: Request, new_instance: DogUpdateIn):
+async def update_dog(user: AdminUser, new_instance: DogUpdateIn):
     """Update an instance of the dog"""
-    session = Session()
-    await session.get_from_request(request)
-    if session.user.is_admin:
-        if new_instance.gender in ("male", "female"):
-            await Dog.filter(id=new_instance.id).update(**new_instance.model_dump(exclude={"id"}))
-            return await DogOut.from_queryset_single(Dog.get(id=new_instance.id))
-        else:
-            return JSONResponse(status_code=422, content="Gender isn't valid")
+    if new_instance.gender in ("male", "female"):
+        await Dog.filter(id=new_instance.id).update(**new_instance.model_dump(exclude={"id"}))
+        dog_cache.invalidate()
+        dogs = await project(DogOut, Dog.filter(id=new_instance.id))
+        if not dogs:
+            return JSONResponse(status_code=404, content="Dog with this id doesn't exist")
+        allocator.set_feed_amount(new_instance.id, new_instance.feed_amount)
+        await event_hub.publish("dog.updated", dogs[0])
+        return dogs[0]
     else:
-        return JSONResponse(status_code=405, content="You doesn't have permissions to update dog")
+        return JSONResponse(status_code=422, content="Gender isn't valid")
 
 
 @api_app.delete("/dog/{dog_id}")
-async def delete_dog(request: Request, dog_id: int):
+async def delete_dog(user: AdminUser, dog_id: int):
     """Delete dog from shelter"""
-    session = Session()
-    await session.get_from_request(request)
-    if session.user.is_admin:
-        await Dog.filter(id=dog_id).delete()
-    else:
-        return JSONResponse(status_code=405, content="You doesn't have permissions to delete dog")
-
-
-@api_app.get("/feed_requests", response_model=List[FeedRequestResponse])
-async def get_users_feed_requests():
+    if await Dog.filter(id=dog_id).delete():
+        dog_cache.invalidate()
+        allocator.remove(dog_id)
+        await event_hub.publish("dog.deleted", {"id": dog_id})
+
+
+@api_app.put("/dog/{dog_id}/photo", response_model=DogOut,
+             responses={**session_responses, 405: {"Method not allowed": {}}, 404: {}, 413: {}, 415: {}})
+async def upload_dog_photo(user: AdminUser, request: Request, dog_id: int, background_tasks: BackgroundTasks):
+    """Upload a dog photo (request body is the image, admin only)"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in photos.photo_types:
+        return JSONResponse(status_code=415, content="Photo must be png, jpeg, webp or gif")
+    if not await Dog.exists(id=dog_id):
+        return JSONResponse(status_code=404, content="Dog with this id doesn't exist")
+    try:
+        name, created = await photos.store_photo(request.stream())
+    except PhotoTooLarge:
+        return JSONResponse(status_code=413, content="Photo is too large")
+    except PhotoNotImage:
+        return JSONResponse(status_code=415, content="Photo must be png, jpeg, webp or gif")
+    if created:
+        background_tasks.add_task(photos.generate_variants, name)
+    await Dog.filter(id=dog_id).update(photo=name)
+    dog_cache.invalidate()
+    dog = await from_queryset_single(DogOut, Dog.filter(id=dog_id).get())
+    await event_hub.publish("dog.updated", dog.model_dump())
+    return dog
+
+
+@api_app.get("/photos/{name}", responses={206: {}, 304: {}, 404: {}, 416: {}})
+async def get_photo(request: Request, name: str):
+    """Provide an uploaded photo or its webp/thumbnail variant"""
+    return photos.photo_response(request, name)
+
+
+@api_app.get("/feed_requests", response_model=List[FeedRequestResponse], responses=list_responses)
+async def get_users_feed_requests(limit: Optional[int] = Query(None, ge=1, le=1000),
+                                  cursor: Optional[str] = None, stream: bool = False):
     """Provide all feed requests from users"""
-    return await FeedRequestResponse.from_queryset(FeedRequest.all().order_by("arrived_at"))
+    return await list_response(FeedRequestResponse, FeedRequest.all(), "arrived_at", limit, cursor, stream)
 
 
 @api_app.get("/feed_requests/current", response_model=List[FeedRequestResponse])
-async def get_user_feed_requests(request: Request):
+async def get_user_feed_requests(user: CurrentUser):
     """Provide all feed requests from current user"""
-    session = Session()
-    await session.get_from_request(request)
-    current_user = await User.get(email=session.user.email)
-    return await FeedRequestResponse.from_queryset(FeedRequest.filter(actor=current_user).order_by("arrived_at"))
-
-
-@api_app.post("/feed_request")
-async def add_feed_request(request: Request, feed_request: FeedRequestIn):
-    """Add feed request to order"""
-    session = Session()
-    await session.get_from_request(request)
-    current_user = await User.get(email=session.user.email)
+    feed_requests = await project(FeedRequestResponse,
+                                  FeedRequest.filter(actor_id=user.email).order_by("arrived_at", "id"))
+    with timed("serialize"):
+        return Response(content=dumps(feed_requests), media_type="application/json")
+
+
+@api_app.post("/feed_request", responses={**session_responses, 404: {}})
+async def add_feed_request(user: CurrentUser, feed_request: FeedRequestIn,
+                           idempotency_key: Optional[str] = Header(None, max_length=64)):
+    """Add feed request to order
+
+    A retry with the same Idempotency-Key header returns the stored feed request instead of adding a new one.
+    """
     if feed_request.feed_amount <= 0:
         return JSONResponse(status_code=422, content="You can't send empty donates")
-    target_dog = await Dog.get(id=feed_request.target_id)
-    data = feed_request.model_dump(exclude={"target_id"})
-    feed_request = FeedRequest(**data, actor=current_user, target=target_dog)
-    await feed_request.save()
-    return feed_request
+    if not await Dog.exists(id=feed_request.target_id):
+        return JSONResponse(status_code=404, content="Dog with this id doesn't exist")
+    try:
+        stored = await feed_request_writer.submit(user.email, feed_request.target_id, feed_request.feed_amount,
+                                                  feed_request.arrived_at, idempotency_key)
+    except IntegrityError:
+        # The dog was deleted meanwhile
+        return JSONResponse(status_code=404, content="Dog with this id doesn't exist")
+    return feed_request_out(stored)
 
 
 @api_app.post("/feed_requests/approve")
-async def approve_feed_request(request: Request, approve_request: FeedRequestApproveRequest):
+async def approve_feed_request(user: AdminUser, approve_request: FeedRequestApproveRequest):
     """Approve or decline the feed request (admin only)"""
-    session = Session()
-    await session.get_from_request(request)
-    if session.user.is_admin:
-        try:
-            feed_request = await FeedRequest.get(id=approve_request.id)
-        except DoesNotExist:
-            return JSONResponse(status_code=404, content="Feed request with this id doesn't exist")
-        await feed_request.fetch_related("target")
-        await feed_request.fetch_related("actor")
-        if approve_request.approved:
-            async with in_transaction():
-                await User.filter(email=feed_request.actor.email).update(
-                    contribution=feed_request.actor.contribution + approve_request.award)
-                await Dog.filter(id=feed_request.target.id).update(
-                    feed_amount=feed_request.target.feed_amount + feed_request.feed_amount)
-        await feed_request.delete()
-    else:
-        return JSONResponse(status_code=405, content="You doesn't have permissions to approve food requests")
+    result = await process_feed_requests([approve_request])
+    if result.missing:
+        return JSONResponse(status_code=404, content="Feed request with this id doesn't exist")
+
+
+@api_app.post("/feed_requests/approve_bulk", response_model=FeedRequestsApproveResult,
+              responses={**session_responses, 405: {"Method not allowed": {}}})
+async def approve_feed_requests(user: AdminUser, approve_requests: List[FeedRequestApproveRequest]):
+    """Approve or decline a list of feed requests in a single transaction (admin only)"""
+    return await process_feed_requests(approve_requests)
 
 
 @api_app.delete("/feed_requests/{request_id}")
-async def delete_user_feed_request(request: Request, request_id: int):
+async def delete_user_feed_request(user: CurrentUser, request_id: int):
     """Delete user feed request (by himself)"""
-    session = Session()
-    await session.get_from_request(request)
-    current_user = await User.get(email=session.user.email)
-    feed_request = await FeedRequest.filter(actor=current_user, id=request_id).get_or_none()
-    if feed_request is None:
+    # The request may be just added, so it's read from the primary
+    pin_to_primary()
+    feed_request = await FeedRequest.filter(actor_id=user.email, id=request_id).values("target_id", "feed_amount")
+    if not feed_request or not await FeedRequest.filter(id=request_id).delete():
         return JSONResponse(status_code=404, content="You feed request doesn't found")
-    else:
-        await feed_request.delete()
+    allocator.add_pending(feed_request[0]["target_id"], -feed_request[0]["feed_amount"])
+    await event_hub.publish("feed_request.deleted", {"id": request_id}, audience=user.email)
+
+
+@api_app.post("/import/{kind}", response_model=ImportResult,
+              responses={**session_responses, 405: {"Method not allowed": {}}, 415: {}})
+async def import_rows(user: AdminUser, request: Request, kind: BulkKind):
+    """Import dogs, users or feed requests from CSV or NDJSON request body (admin only)
+
+    Rows are inserted by batches, invalid rows are skipped and reported with their line numbers.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    bulk_format = bulk.import_formats.get(content_type)
+    if bulk_format is None:
+        return JSONResponse(status_code=415, content="Body must be text/csv or application/x-ndjson")
+    return await bulk.import_rows(kind, bulk_format, request.stream())
+
+
+@api_app.get("/export/{kind}", responses={**session_responses, 405: {"Method not allowed": {}},
+                                          200: {"content": {"text/csv": {}, "application/x-ndjson": {}}}})
+async def export_rows(user: AdminUser, kind: BulkKind, format: BulkFormat = BulkFormat.ndjson):
+    """Export dogs, users or feed requests as CSV or NDJSON stream (admin only)"""
+    return StreamingResponse(bulk.export_rows(kind, format), media_type=bulk.export_media_types[format],
+                             headers={"Content-Disposition": f'attachment; filename="{kind.value}.{format.value}"'})
+
+
+@api_app.get("/events", responses={**session_responses, 200: {"content": {"text/event-stream": {}}}})
+async def get_events(user: CurrentUser, topics: Optional[str] = Query(None, description="e.g. dog,feed_request")):
+    """Stream dog and feed request changes as server-sent events instead of polling
+
+    Events are dog.created, dog.updated, dog.deleted, feed_request.created, feed_request.approved,
+    feed_request.declined and feed_request.deleted, their data is the changed fields as JSON.
+    Feed request events are sent to admins and the user, who made the request, only.
+    A stream, which falls behind, is closed: reconnect and reload the lists.
+    """
+    subscription = event_hub.subscribe(user.email, user.is_admin,
+                                       [topic.strip() for topic in topics.split(",") if topic.strip()]
+                                       if topics else None)
+    return StreamingResponse(event_hub.stream(subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 def start():
-    """Launch uvicorn application"""
-    uvicorn.run("fircode.main:app", host="127.0.0.1", port=8000, reload=True)
+    """Launch uvicorn workers (see server settings in config)"""
+    server.run("fircode.main:app")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import fastapi.routing
+from fastapi.logger import logger
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from fircode import config
+
+duration_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+query_count_buckets = (0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 50, 100)
+query_methods = ("execute_query", "execute_query_dict", "execute_insert", "execute_many", "execute_script")
+
+
+@dataclass
+class RequestTimings:
+    """Time spent by the current request in every phase (db, bcrypt, serialize)"""
+    started: float = field(default_factory=time.perf_counter)
+    db_queries: int = 0
+    phases: Dict[str, float] = field(default_factory=dict)
+
+    def add(self, phase: str, duration: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def server_timing(self) -> str:
+        parts = [f'db;dur={self.phases.get("db", 0.0) * 1000:.2f};desc="{self.db_queries} queries"']
+        for phase, duration in self.phases.items():
+            if phase != "db":
+                parts.append(f"{phase};dur={duration * 1000:.2f}")
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(parts)
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """Prometheus histogram with labels"""
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...]) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> (bucket counts, sum, count)
+        self.series: Dict[Tuple[Tuple[str, str], ...], List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def exposition(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, count) in self.series.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in key)
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+request_duration = Histogram("fircode_request_duration_seconds", "Request duration by route", duration_buckets)
+request_db_queries = Histogram("fircode_request_db_queries", "DB queries per request by route", query_count_buckets)
+request_db_duration = Histogram("fircode_request_db_duration_seconds", "DB time per request by route",
+                                duration_buckets)
+phase_duration = Histogram("fircode_phase_duration_seconds", "Time of bcrypt and serialization phases",
+                           duration_buckets)
+histograms = (request_duration, request_db_queries, request_db_duration, phase_duration)
+
+
+@contextmanager
+def timed(phase: str):
+    """Adds duration of the block to the phase of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(phase, duration)
+        phase_duration.observe(duration, phase=phase)
+
+
+def _timed_query(method):
+    @functools.wraps(method)
+    async def wrapper(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, query, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            timings = _request_timings.get()
+            if timings is not None:
+                timings.db_queries += 1
+                timings.add("db", duration)
+            if duration * 1000 > config.slow_query_threshold:
+                logger.warning(f"Slow query ({duration * 1000:.1f} ms): {query}")
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _timed_serialization(serialize):
+    @functools.wraps(serialize)
+    async def wrapper(*args, **kwargs):
+        with timed("serialize"):
+            return await serialize(*args, **kwargs)
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _client_classes(cls=BaseDBAsyncClient):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _client_classes(subclass)
+
+
+def instrument() -> None:
+    """Time queries of every loaded tortoise backend and FastAPI response serialization"""
+    for cls in _client_classes():
+        for name in query_methods:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "instrumented", False):
+                setattr(cls, name, _timed_query(method))
+    if not getattr(fastapi.routing.serialize_response, "instrumented", False):
+        fastapi.routing.serialize_response = _timed_serialization(fastapi.routing.serialize_response)
+
+
+class MetricsMiddleware:
+    """Collects per-request timings, adds Server-Timing header and fills route histograms"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+
+        async def send_with_timing(message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": route.path if route is not None else "unmatched"}
+            request_duration.observe(time.perf_counter() - timings.started, **labels)
+            request_db_queries.observe(timings.db_queries, **labels)
+            request_db_duration.observe(timings.phases.get("db", 0.0), **labels)
+
+
+def gauges(prefix: str, stats: dict) -> List[str]:
+    """Exports numeric stats as Prometheus gauges"""
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+    return lines
+
+
+def exposition(extra: Optional[Dict[str, dict]] = None) -> str:
+    """Returns metrics of this worker in Prometheus text format"""
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.exposition())
+    for prefix, stats in (extra or {}).items():
+        lines.extend(gauges(prefix, stats))
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,8 @@
 from datetime import date
 from enum import Enum
+from typing import List, Optional
 
-from pydantic import BaseModel, StringConstraints, EmailStr
+from pydantic import BaseModel, StringConstraints, EmailStr, model_validator, Field
 from pydantic.networks import MAX_EMAIL_LENGTH
 from pydantic_extra_types.phone_numbers import PhoneNumber
 from tortoise import Tortoise
@@ -10,6 +11,8 @@ from tortoise import models
 from tortoise.contrib.pydantic import pydantic_model_creator
 from typing_extensions import Annotated
 
+from fircode import photos
+
 
 class User(models.Model):
     """User model"""
@@ -29,15 +32,27 @@ class User(models.Model):
 
 
 class SessionToken(models.Model):
-    token = fields.CharField(min_length=128, max_length=512, pk=True)
+    """Session, the token from the cookie is stored as its sha256 hex digest"""
+    token = fields.CharField(min_length=64, max_length=64, pk=True)
     user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField(
         "shelter.User"
     )
+    created_at = fields.DatetimeField(auto_now_add=True)
+    expires_at = fields.DatetimeField(index=True)
 
     class Meta:
         table = "session_token"
 
 
+class SchemaVersion(models.Model):
+    """Fingerprint of the generated schema, tables are checked only when it changes"""
+    id = fields.IntField(pk=True)
+    fingerprint = fields.CharField(max_length=64)
+
+    class Meta:
+        table = "schema_version"
+
+
 class Gender(str, Enum):
     male = 'male'
     female = 'female'
@@ -50,9 +65,18 @@ class Dog(models.Model):
     gender = fields.CharEnumField(enum_type=Gender, max_length=10)
     age = fields.IntField()
     description = fields.TextField(max_lenght=1024)
-    feed_amount = fields.IntField(default=0)
+    feed_amount = fields.IntField(default=0, index=True)
     host = fields.ForeignKeyField("shelter.User", null=True)
 
+    def photo_url(self) -> str:
+        return photos.photo_url(self.photo)
+
+    def webp_url(self) -> str:
+        return photos.webp_url(self.photo)
+
+    def thumbnail_url(self) -> str:
+        return photos.thumbnail_url(self.photo)
+
 
 class FeedRequest(models.Model):
     id = fields.IntField(pk=True)
@@ -61,6 +85,60 @@ class FeedRequest(models.Model):
     arrived_at = fields.DateField()
     approved = fields.BooleanField(default=False)
     target = fields.ForeignKeyField("shelter.Dog")
+    # Client supplied Idempotency-Key header or a generated one
+    idempotency_key = fields.CharField(max_length=64, null=True)
+
+    class Meta:
+        unique_together = (("actor", "idempotency_key"),)
+
+
+class Donation(models.Model):
+    """Ledger of approved feed requests, rows are only appended
+
+    Users and dogs are plain columns, so the history outlives them.
+    """
+    id = fields.IntField(pk=True)
+    feed_request_id = fields.IntField()
+    actor_id = fields.CharField(max_length=MAX_EMAIL_LENGTH, index=True)
+    dog_id = fields.IntField(index=True)
+    feed_amount = fields.IntField()
+    award = fields.IntField()
+    arrived_at = fields.DateField()
+    approved_at = fields.DatetimeField(auto_now_add=True, index=True)
+
+    class Meta:
+        table = "donation"
+
+
+class DailyDonations(models.Model):
+    """Donations rollup by approval day (UTC), maintained with the ledger"""
+    day = fields.DateField(pk=True)
+    feed_amount = fields.IntField(default=0)
+    donations = fields.IntField(default=0)
+
+    class Meta:
+        table = "donations_daily"
+
+
+class DogDonations(models.Model):
+    """Donations rollup by dog, maintained with the ledger"""
+    dog_id = fields.IntField(pk=True, generated=False)
+    feed_amount = fields.IntField(default=0)
+    donations = fields.IntField(default=0)
+
+    class Meta:
+        table = "donations_by_dog"
+
+
+class UserDonations(models.Model):
+    """Donations rollup by donor, maintained with the ledger"""
+    actor_id = fields.CharField(max_length=MAX_EMAIL_LENGTH, pk=True)
+    feed_amount = fields.IntField(default=0)
+    donations = fields.IntField(default=0)
+    award = fields.IntField(default=0)
+
+    class Meta:
+        table = "donations_by_user"
 
 
 class UserRegistrationRequest(BaseModel):
@@ -88,6 +166,106 @@ class FeedRequestApproveRequest(BaseModel):
     award: int
 
 
+class FeedRequestsApproveResult(BaseModel):
+    approved: int
+    declined: int
+    missing: List[int]
+
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    first_name: str
+    second_name: str
+    contribution: int
+
+
+class LeaderboardPosition(BaseModel):
+    rank: int
+    contribution: int
+    total: int
+
+
+class DogAllocation(BaseModel):
+    dog_id: int
+    name: str
+    units: int
+    feed_amount: int
+    pending: int
+
+
+class DonationTotals(BaseModel):
+    feed_amount: int
+    donations: int
+
+
+class DailyDonationTotals(BaseModel):
+    day: date
+    feed_amount: int
+    donations: int
+
+
+class UserDonationTotals(DonationTotals):
+    award: int
+
+
+class BulkKind(str, Enum):
+    dogs = "dogs"
+    users = "users"
+    feed_requests = "feed_requests"
+
+
+class BulkFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+class DogImportRow(BaseModel):
+    name: Annotated[str, StringConstraints(min_length=1, max_length=32)]
+    photo: str = "dog_photo.png"
+    gender: Gender
+    age: int
+    description: str
+    feed_amount: int = 0
+    host_id: Optional[EmailStr] = None
+
+
+class UserImportRow(BaseModel):
+    """Either a plain password or a bcrypt hash exported from another installation"""
+    email: EmailStr
+    phone: PhoneNumber
+    first_name: Annotated[str, StringConstraints(min_length=2, max_length=64)]
+    second_name: Annotated[str, StringConstraints(min_length=2, max_length=64)]
+    is_admin: bool = False
+    contribution: int = 0
+    password: Optional[Annotated[str, StringConstraints(min_length=1, max_length=512)]] = None
+    hashed_password: Optional[Annotated[str, StringConstraints(pattern=r"^\$2[abxy]?\$\d{2}\$[./A-Za-z0-9]{53}$")]] = None
+
+    @model_validator(mode="after")
+    def check_password(self) -> "UserImportRow":
+        if (self.password is None) == (self.hashed_password is None):
+            raise ValueError("Either password or hashed_password is required")
+        return self
+
+
+class FeedRequestImportRow(BaseModel):
+    actor_id: EmailStr
+    target_id: int
+    feed_amount: Annotated[int, Field(gt=0)]
+    arrived_at: date
+    approved: bool = False
+
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[ImportRowError]
+
+
 Tortoise.init_models(["fircode.models"], "shelter")
 
 UserResponse = pydantic_model_creator(User, name="User", exclude=("actor", "session_tokens", "dogs.feedrequests"))
@@ -96,7 +274,9 @@ UserResponseForStat = pydantic_model_creator(User, name="UserResponseForStat",
                                                       "dogs.feedrequests"))
 DogIn = pydantic_model_creator(Dog, exclude_readonly=True, name="DogIn", exclude=("host", "host_id"))
 DogOut = pydantic_model_creator(Dog, name="DogOut", exclude=(
-    "host.email", "host.phone", "host.is_admin", "host.actor", "host.session_tokens", "feedrequests",))
+    "host.email", "host.phone", "host.is_admin", "host.actor", "host.session_tokens", "feedrequests",),
+                                computed=("photo_url", "webp_url", "thumbnail_url"))
 DogUpdateIn = pydantic_model_creator(Dog, name="DogUpdateIn", exclude=("host", "feedrequests", "host_id"))
 FeedRequestResponse = pydantic_model_creator(FeedRequest, name="FeedRequestResponse",
-                                             exclude=("actor.session_tokens", "actor.dogs", "target.host"))
+                                             exclude=("actor.session_tokens", "actor.dogs", "target.host",
+                                                      "idempotency_key"))
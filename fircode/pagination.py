@@ -0,0 +1,123 @@
+import base64
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Type
+
+from fastapi import Response
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from pydantic_core import to_jsonable_python
+from tortoise.expressions import Q
+from tortoise.queryset import QuerySet
+
+from fircode.metrics import timed
+from fircode.serialization import dumps, projection_for
+
+# Rows fetched per query, when the whole table is streamed
+stream_batch_size = 500
+next_cursor_header = "X-Next-Cursor"
+
+
+class Keyset:
+    """Keyset (seek) ordering by a column with the primary key as a tiebreak"""
+
+    def __init__(self, queryset: QuerySet, order: str) -> None:
+        self.queryset = queryset
+        self.model = queryset.model
+        self.descending = order.startswith("-")
+        self.field = order.lstrip("-")
+        self.pk = self.model._meta.pk_attr
+
+    @property
+    def ordering(self) -> Tuple[str, str]:
+        prefix = "-" if self.descending else ""
+        return prefix + self.field, prefix + self.pk
+
+    def encode_cursor(self, row: Dict[str, Any]) -> str:
+        values = to_jsonable_python([row[self.field], row[self.pk]])
+        return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, cursor: str) -> Tuple:
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            fields_map = self.model._meta.fields_map
+            return fields_map[self.field].to_python_value(value), fields_map[self.pk].to_python_value(pk)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=422, detail="Invalid cursor")
+
+    def after(self, cursor: Optional[str]) -> QuerySet:
+        """Returns ordered queryset, which starts right after the cursor"""
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor is None:
+            return queryset
+        value, pk = self.decode_cursor(cursor)
+        op = "lt" if self.descending else "gt"
+        return queryset.filter(
+            Q(**{f"{self.field}__{op}": value}) | Q(**{self.field: value, f"{self.pk}__{op}": pk})
+        )
+
+
+async def fetch_page(pydantic_model: Type[BaseModel], keyset: Keyset, limit: int,
+                     cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Returns up to limit rows after the cursor and the cursor of the next page"""
+    rows, items = await projection_for(pydantic_model).fetch(keyset.after(cursor).limit(limit + 1), (keyset.field,))
+    next_cursor = keyset.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return items[:limit], next_cursor
+
+
+async def iterate(pydantic_model: Type[BaseModel], keyset: Keyset, cursor: Optional[str] = None,
+                  limit: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Yields rows after the cursor batch by batch, so a table is never loaded at once"""
+    left = limit
+    while left is None or left > 0:
+        batch_size = stream_batch_size if left is None else min(left, stream_batch_size)
+        items, cursor = await fetch_page(pydantic_model, keyset, batch_size, cursor)
+        for item in items:
+            yield item
+        if left is not None:
+            left -= len(items)
+        if cursor is None:
+            break
+
+
+async def iterate_values(keyset: Keyset, fields: Sequence[str]) -> AsyncIterator[Dict[str, Any]]:
+    """Yields .values() rows in keyset order, stream_batch_size rows per query"""
+    lookups = list(dict.fromkeys([*fields, keyset.field, keyset.pk]))
+    cursor = None
+    while True:
+        rows = await keyset.after(cursor).limit(stream_batch_size + 1).values(*lookups)
+        for row in rows[:stream_batch_size]:
+            yield row
+        if len(rows) <= stream_batch_size:
+            break
+        cursor = keyset.encode_cursor(rows[stream_batch_size - 1])
+
+
+async def _ndjson_lines(items: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield dumps(item) + b"\n"
+
+
+async def fetch_list(pydantic_model: Type[BaseModel], queryset: QuerySet, order: str,
+                     limit: Optional[int] = None,
+                     cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Returns the full list or a keyset page and the cursor of the next page"""
+    keyset = Keyset(queryset, order)
+    if limit is None and cursor is None:
+        _, items = await projection_for(pydantic_model).fetch(keyset.after(None))
+        return items, None
+    return await fetch_page(pydantic_model, keyset, limit or stream_batch_size, cursor)
+
+
+async def list_response(pydantic_model: Type[BaseModel], queryset: QuerySet, order: str,
+                        limit: Optional[int] = None, cursor: Optional[str] = None, stream: bool = False) -> Response:
+    """Returns a list endpoint result: full list, a keyset page or NDJSON stream"""
+    if stream:
+        return StreamingResponse(
+            _ndjson_lines(iterate(pydantic_model, Keyset(queryset, order), cursor, limit)),
+            media_type="application/x-ndjson"
+        )
+    items, next_cursor = await fetch_list(pydantic_model, queryset, order, limit, cursor)
+    headers = {next_cursor_header: next_cursor} if next_cursor is not None else None
+    with timed("serialize"):
+        return Response(content=dumps(items), media_type="application/json", headers=headers)
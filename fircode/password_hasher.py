@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+from fircode import config
+from fircode.exceptions import HasherOverloaded
+from fircode.metrics import timed
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed_password)
+
+
+def _percentile(samples: list, percent: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent))]
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded worker pool, so it doesn't block the event loop"""
+
+    def __init__(self, workers: int, queue_size: int, use_processes: bool = False, rounds: int = 12) -> None:
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.use_processes = use_processes
+        self.rounds = rounds
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self._latencies: deque = deque(maxlen=1024)
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HasherOverloaded
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            with timed("bcrypt"):
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+            latency = time.perf_counter() - started
+            self.completed += 1
+            self.total_latency += latency
+            self._latencies.append(latency)
+
+    async def warm_up(self) -> None:
+        """Start the pool before the first login, spawning worker processes takes a while"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, int) for _ in range(self.workers)))
+
+    async def hash(self, password: str) -> str:
+        """Returns bcrypt hash of the password"""
+        hashed_password: bytes = await self._run(_hash_password, password.encode("utf-8"), self.rounds)
+        return hashed_password.decode("utf-8")
+
+    async def check(self, password: str, hashed_password: str) -> bool:
+        """Returns true, if the password matches the hash"""
+        return await self._run(_check_password, password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    def stats(self) -> dict:
+        latencies = list(self._latencies)
+        return {
+            "executor": "process" if self.use_processes else "thread",
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "rounds": self.rounds,
+            "in_flight": min(self.pending, self.workers),
+            "queued": max(0, self.pending - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "latency_avg": self.total_latency / self.completed if self.completed else 0.0,
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p99": _percentile(latencies, 0.99),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(
+    workers=config.hasher_workers,
+    queue_size=config.hasher_queue_size,
+    use_processes=config.hasher_executor == "process",
+    rounds=config.bcrypt_rounds
+)
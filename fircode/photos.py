@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from typing import AsyncIterator, Iterator, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.logger import logger
+from fastapi.responses import FileResponse, StreamingResponse
+
+from fircode import config
+from fircode.exceptions import PhotoNotImage, PhotoTooLarge
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+photo_types = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+photo_name_pattern = re.compile(r"^(?P<digest>[0-9a-f]{64})(?P<variant>_thumb|_web)?(?P<ext>\.png|\.jpg|\.webp|\.gif)$")
+photos_url = "/api/photos/"
+range_pattern = re.compile(r"^bytes=(?P<start>\d*)-(?P<end>\d*)$")
+chunk_size = 64 * 1024
+
+
+def photos_directory() -> str:
+    return os.path.join(config.media_directory, "photos")
+
+
+def photo_path(name: str) -> str:
+    """Returns path of a content addressed photo, files are spread over 256 subdirectories"""
+    return os.path.join(photos_directory(), name[:2], name)
+
+
+def variant_names(name: str) -> Optional[Tuple[str, str]]:
+    """Returns (webp, thumbnail) names of an uploaded photo or None for legacy photos
+
+    Variants have suffixes, so they never replace the original (a webp one too), whose name is its digest.
+    """
+    match = photo_name_pattern.match(name)
+    if match is None or match["variant"]:
+        return None
+    return f"{match['digest']}_web.webp", f"{match['digest']}_thumb.webp"
+
+
+def photo_url(name: str) -> str:
+    return photos_url + name if photo_name_pattern.match(name) else name
+
+
+def webp_url(name: str) -> str:
+    variants = variant_names(name)
+    return photos_url + variants[0] if variants else photo_url(name)
+
+
+def thumbnail_url(name: str) -> str:
+    variants = variant_names(name)
+    return photos_url + variants[1] if variants else photo_url(name)
+
+
+def original_name(digest: str) -> Optional[str]:
+    """Returns name of the uploaded original by its digest"""
+    for ext in photo_types.values():
+        name = digest + ext
+        if os.path.isfile(photo_path(name)):
+            return name
+    return None
+
+
+def sniff_photo_type(header: bytes) -> Optional[str]:
+    """Returns content type of a supported image by its first 12 bytes"""
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _photo_type(path: str) -> Optional[str]:
+    """Returns content type of the file or None, if it isn't a supported image"""
+    with open(path, "rb") as file:
+        content_type = sniff_photo_type(file.read(12))
+    if content_type is None or Image is None:
+        return content_type
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except Exception:
+        return None
+    return content_type
+
+
+async def store_photo(chunks: AsyncIterator[bytes]) -> Tuple[str, bool]:
+    """Saves uploaded photo by its sha256, returns (name, created)
+
+    The same photo uploaded twice is stored once. The extension is taken from the image itself,
+    PhotoNotImage is raised for anything else.
+    """
+    os.makedirs(photos_directory(), exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=photos_directory(), suffix=".upload", delete=False) as file:
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > config.photo_max_size:
+                    raise PhotoTooLarge
+                digest.update(chunk)
+                file.write(chunk)
+        except BaseException:
+            file.close()
+            os.unlink(file.name)
+            raise
+
+    content_type = await asyncio.to_thread(_photo_type, file.name)
+    if content_type is None:
+        os.unlink(file.name)
+        raise PhotoNotImage
+    name = digest.hexdigest() + photo_types[content_type]
+    path = photo_path(name)
+    if os.path.exists(path):
+        os.unlink(file.name)
+        return name, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(file.name, path)
+    return name, True
+
+
+def _save_atomically(image, path: str) -> None:
+    temp_path = path + ".tmp"
+    image.save(temp_path, "WEBP", quality=config.photo_webp_quality)
+    os.replace(temp_path, path)
+
+
+def generate_variants(name: str) -> None:
+    """Builds webp and thumbnail variants of an uploaded photo (runs in a background thread)"""
+    variants = variant_names(name)
+    if variants is None:
+        return
+    if Image is None:
+        logger.warning("Pillow isn't installed, photo variants aren't generated")
+        return
+    webp_name, thumbnail_name = variants
+    try:
+        with Image.open(photo_path(name)) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            thumbnail = ImageOps.fit(image, (config.photo_thumbnail_size, config.photo_thumbnail_size))
+            _save_atomically(thumbnail, photo_path(thumbnail_name))
+            image.thumbnail((config.photo_webp_max_size, config.photo_webp_max_size))
+            _save_atomically(image, photo_path(webp_name))
+    except Exception:
+        # The original is served instead of the variants
+        logger.exception(f"Variants of photo {name} aren't generated")
+
+
+def _read_range(path: str, start: int, length: int) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Returns (start, end) of a single bytes range, end is inclusive"""
+    match = range_pattern.match(header.strip())
+    if match is None or not (match["start"] or match["end"]):
+        return None
+    if not match["start"]:
+        start, end = max(0, size - int(match["end"])), size - 1
+    else:
+        start = int(match["start"])
+        end = min(int(match["end"]), size - 1) if match["end"] else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def photo_response(request: Request, name: str) -> Response:
+    """Serves a photo or its variant with ETag and Range support
+
+    Photos are content addressed, so they are cached forever. A variant, which isn't generated yet,
+    is replaced with the original photo.
+    """
+    match = photo_name_pattern.match(name)
+    if match is None:
+        return Response(status_code=404)
+    cache_control = "public, max-age=31536000, immutable"
+    if not os.path.isfile(photo_path(name)):
+        name = original_name(match["digest"]) if match["variant"] else None
+        if name is None:
+            return Response(status_code=404)
+        # The variant will appear later under this url
+        cache_control = "no-cache"
+
+    path = photo_path(name)
+    stat_result = os.stat(path)
+    media_type = "image/webp" if name.endswith(".webp") else \
+        next(media_type for media_type, ext in photo_types.items() if name.endswith(ext))
+    headers = {
+        "ETag": f'"{name}"',
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and headers["ETag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+
+    if config.media_accel_redirect:
+        # Let nginx send the file with sendfile(), it handles Range requests too
+        relative_path = os.path.relpath(path, config.media_directory).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = config.media_accel_redirect.rstrip("/") + "/" + relative_path
+        return Response(media_type=media_type, headers=headers)
+
+    range_header = request.headers.get("range")
+    # Several ranges aren't supported, so the header is ignored and the whole photo is sent (RFC 9110, 14.2)
+    if range_header is not None and "," not in range_header:
+        byte_range = _parse_range(range_header, stat_result.st_size)
+        if byte_range is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stat_result.st_size}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(_read_range(path, start, end - start + 1), status_code=206,
+                                 media_type=media_type, headers=headers)
+
+    return FileResponse(path, stat_result=stat_result, media_type=media_type, headers=headers)
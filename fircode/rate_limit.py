@@ -0,0 +1,155 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import Request
+
+from fircode import config
+from fircode.exceptions import RateLimited
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Key hash, tokens left, last update (unix time)
+_slot = struct.Struct("<Qdd")
+# Slots checked for a key before the least recently updated one is reused
+_probes = 8
+
+
+def _key_hash(key: str) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class SharedBuckets:
+    """Token buckets in a memory-mapped file, shared by every worker process of the host
+
+    The file is an open addressing table of fixed size slots and an exclusive file lock is held
+    for one acquire only, so workers see each other's attempts at once. A bucket, which is full again,
+    is as good as a missing one, so its slot is reused.
+    """
+
+    def __init__(self, path: str, slots: int) -> None:
+        self.path = path
+        self.slots = slots
+        self._pid: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+
+    def _open(self) -> None:
+        # Workers are separate processes, each maps the file by itself
+        if self._pid == os.getpid():
+            return
+        size = self.slots * _slot.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+
+    def _find(self, key_hash: int, now: float, limit: int, window: float) -> Tuple[int, float]:
+        """Returns offset and refilled tokens of the key's bucket"""
+        start = key_hash % self.slots
+        free: Optional[int] = None
+        oldest: Tuple[float, int] = (math.inf, 0)
+        for probe in range(_probes):
+            offset = (start + probe) % self.slots * _slot.size
+            slot_hash, tokens, updated_at = _slot.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, min(limit, tokens + (now - updated_at) * limit / window)
+            if free is None and (slot_hash == 0 or now - updated_at >= window):
+                free = offset
+            oldest = min(oldest, (updated_at, offset))
+        return (oldest[1] if free is None else free), float(limit)
+
+    def acquire(self, limits: Sequence[Tuple[str, int, float]]) -> Tuple[float, Optional[int]]:
+        """Takes a token from every (key, limit, window) bucket or from none of them
+
+        Returns (0, None) on success, otherwise seconds until a retry can succeed and the index
+        of the bucket, which has the longest wait.
+        """
+        self._open()
+        now = time.time()
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            buckets = []
+            wait, rejected_by = 0.0, None
+            for index, (key, limit, window) in enumerate(limits):
+                key_hash = _key_hash(key)
+                offset, tokens = self._find(key_hash, now, limit, window)
+                buckets.append((offset, key_hash, tokens))
+                if tokens < 1 and (1 - tokens) * window / limit > wait:
+                    wait, rejected_by = (1 - tokens) * window / limit, index
+            if rejected_by is not None:
+                return wait, rejected_by
+            for offset, key_hash, tokens in buckets:
+                _slot.pack_into(self._map, offset, key_hash, tokens - 1, now)
+            return 0.0, None
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """Limits attempts of an action per client IP and per email"""
+
+    def __init__(self, buckets: SharedBuckets, enabled: bool, window: float) -> None:
+        self.buckets = buckets
+        self.enabled = enabled
+        self.window = window
+        self.allowed = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+
+    def check(self, action: str, ip: str, email: Optional[str], ip_limit: int, email_limit: int) -> None:
+        if not self.enabled:
+            return
+        limits: List[Tuple[str, int, float]] = [(f"{action}:ip:{ip}", ip_limit, self.window)]
+        kinds = ["ip"]
+        if email:
+            limits.append((f"{action}:email:{email}", email_limit, self.window))
+            kinds.append("email")
+        retry_after, rejected_by = self.buckets.acquire(limits)
+        if rejected_by is not None:
+            self.rejected[f"{action}_{kinds[rejected_by]}"] += 1
+            raise RateLimited(retry_after)
+        self.allowed += 1
+
+    def dependency(self, action: str, ip_limit: int, email_limit: int):
+        """Returns a route dependency, which limits requests with JSON body containing "email" """
+        # Export rejection counters before the first rejection
+        self.rejected[f"{action}_ip"] += 0
+        self.rejected[f"{action}_email"] += 0
+
+        async def limit(request: Request) -> None:
+            email = None
+            try:
+                body = await request.json()
+                if isinstance(body, dict) and isinstance(body.get("email"), str):
+                    email = body["email"].strip().lower()
+            except ValueError:
+                # The route reports the invalid body itself
+                pass
+            self.check(action, request.client.host if request.client else "unknown", email, ip_limit, email_limit)
+
+        return limit
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "allowed": self.allowed,
+            **{f"rejected_{name}": count for name, count in sorted(self.rejected.items())},
+        }
+
+
+rate_limiter = RateLimiter(SharedBuckets(config.rate_limit_path, config.rate_limit_slots),
+                           enabled=config.rate_limit, window=config.rate_limit_window)
+login_rate_limit = rate_limiter.dependency("login", config.login_ip_limit, config.login_email_limit)
+registration_rate_limit = rate_limiter.dependency("registration", config.registration_ip_limit,
+                                                  config.registration_email_limit)
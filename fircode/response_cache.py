@@ -0,0 +1,47 @@
+import hashlib
+from typing import Awaitable, Callable, Dict, Hashable, Tuple
+
+from fastapi import Request, Response
+
+from fircode import config
+from fircode.cache import TTLCache
+
+
+class ResponseCache:
+    """Serialized JSON responses, dropped as a whole when the data changes
+
+    Every write path bumps the version, ttl only bounds staleness caused by writes on other workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.entries = TTLCache(max_size=max_size, ttl=ttl)
+        self.version = 0
+
+    def invalidate(self) -> None:
+        self.version += 1
+        self.entries.clear()
+
+    async def respond(self, request: Request, key: Hashable,
+                      build: Callable[[], Awaitable[Tuple[bytes, Dict[str, str]]]]) -> Response:
+        """Returns cached body (or 304), building it on a miss"""
+        entry = self.entries.get(key)
+        if entry is None:
+            version = self.version
+            body, headers = await build()
+            etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+            entry = (etag, body, headers)
+            # Don't store a body built from data, which was changed while it was being built
+            if version == self.version:
+                self.entries.set(key, entry)
+        etag, body, headers = entry
+        headers = {**headers, "ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self) -> dict:
+        return {"version": self.version, **self.entries.stats()}
+
+
+dog_cache = ResponseCache(max_size=config.dog_cache_size, ttl=config.dog_cache_ttl)
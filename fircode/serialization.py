@@ -0,0 +1,149 @@
+import typing
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Sequence, Tuple, Type
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pydantic_core import to_json
+from tortoise.contrib.pydantic import PydanticModel
+from tortoise.contrib.pydantic.base import _get_fetch_fields
+from tortoise.queryset import QuerySet, QuerySetSingle
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Max ids in one "IN (...)" of a reverse relation query
+children_batch_size = 1000
+
+
+def dumps(content: Any) -> bytes:
+    """Encodes content to JSON with orjson, if it's installed"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return to_json(content)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def load_related(pydantic_model: Type[PydanticModel], queryset: QuerySet) -> QuerySet:
+    """Joins forward relations of the pydantic model and prefetches the rest
+
+    Either way, rows cost a constant number of queries instead of one per row.
+    """
+    meta = queryset.model._meta
+    fetch_fields = _get_fetch_fields(pydantic_model, queryset.model)
+    joined = [name for name in fetch_fields if name in meta.fk_fields or name in meta.o2o_fields]
+    prefetched = [name for name in fetch_fields if name not in joined]
+    if joined:
+        queryset = queryset.select_related(*joined)
+    if prefetched:
+        queryset = queryset.prefetch_related(*prefetched)
+    return queryset
+
+
+async def from_queryset_single(pydantic_model: Type[PydanticModel], queryset: QuerySetSingle) -> PydanticModel:
+    return pydantic_model.model_validate(await load_related(pydantic_model, queryset))
+
+
+def _nested_model(annotation) -> Type[BaseModel]:
+    for arg in typing.get_args(annotation) or (annotation,):
+        if isinstance(arg, type) and issubclass(arg, BaseModel):
+            return arg
+        nested = typing.get_args(arg)
+        if nested:
+            return _nested_model(arg)
+    raise TypeError(f"{annotation} isn't a pydantic model")
+
+
+class Projection:
+    """Output of a pydantic_model_creator model built from .values() rows
+
+    Serializes the same fields in the same order as the pydantic model, but skips building
+    model instances: forward relations become joined columns, reverse ones a query per relation.
+    """
+
+    def __init__(self, pydantic_model: Type[BaseModel]) -> None:
+        self.model = pydantic_model.model_config["orig_model"]
+        meta = self.model._meta
+        self.pk = meta.pk_attr
+        self.columns: List[str] = []
+        # name -> (projection, fk column)
+        self.nested: Dict[str, Tuple["Projection", str]] = {}
+        # name -> (projection, relation column, related model)
+        self.children: Dict[str, Tuple["Projection", str, Any]] = {}
+        self.order: List[str] = list(pydantic_model.model_fields)
+        self.computed: List[str] = list(pydantic_model.model_computed_fields)
+        for name, info in pydantic_model.model_fields.items():
+            if name in meta.fk_fields or name in meta.o2o_fields:
+                self.nested[name] = (Projection(_nested_model(info.annotation)), meta.fields_map[name].source_field)
+            elif name in meta.backward_fk_fields:
+                field = meta.fields_map[name]
+                self.children[name] = (Projection(_nested_model(info.annotation)), field.relation_field,
+                                       field.related_model)
+            elif name in meta.db_fields:
+                self.columns.append(name)
+            else:
+                raise TypeError(f"Field {name} of {pydantic_model.__name__} can't be projected")
+
+    def lookups(self, prefix: str = "") -> List[str]:
+        lookups = [prefix + self.pk] + [prefix + name for name in self.columns]
+        for name, (projection, fk_column) in self.nested.items():
+            lookups.append(prefix + fk_column)
+            lookups.extend(projection.lookups(f"{prefix}{name}__"))
+        return list(dict.fromkeys(lookups))
+
+    def shape(self, row: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+        item = {}
+        for name in self.order:
+            if name in self.nested:
+                projection, fk_column = self.nested[name]
+                item[name] = None if row[prefix + fk_column] is None else projection.shape(row, f"{prefix}{name}__")
+            elif name in self.children:
+                item[name] = []
+            else:
+                item[name] = row[prefix + name]
+        if self.computed:
+            instance = SimpleNamespace(**{name: row[prefix + name] for name in self.columns})
+            for name in self.computed:
+                item[name] = getattr(self.model, name)(instance)
+        return item
+
+    async def fetch(self, queryset: QuerySet,
+                    extra_lookups: Sequence[str] = ()) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Returns raw rows (with the primary key and sort columns) and serializable items"""
+        rows = await queryset.values(*dict.fromkeys([*self.lookups(), *extra_lookups]))
+        items = [self.shape(row) for row in rows]
+        for name, (projection, relation_column, related_model) in self.children.items():
+            groups = defaultdict(list)
+            pks = [row[self.pk] for row in rows]
+            for start in range(0, len(pks), children_batch_size):
+                child_queryset = related_model.filter(**{f"{relation_column}__in": pks[start:start + children_batch_size]})
+                child_rows, child_items = await projection.fetch(child_queryset.order_by(projection.pk),
+                                                                 (relation_column,))
+                for child_row, child_item in zip(child_rows, child_items):
+                    groups[child_row[relation_column]].append(child_item)
+            for row, item in zip(rows, items):
+                item[name] = groups.get(row[self.pk], [])
+        return rows, items
+
+
+_projections: Dict[Type[BaseModel], Projection] = {}
+
+
+def projection_for(pydantic_model: Type[BaseModel]) -> Projection:
+    projection = _projections.get(pydantic_model)
+    if projection is None:
+        projection = _projections[pydantic_model] = Projection(pydantic_model)
+    return projection
+
+
+async def project(pydantic_model: Type[BaseModel], queryset: QuerySet) -> List[Dict[str, Any]]:
+    """Returns rows of the queryset serialized like the pydantic model"""
+    _, items = await projection_for(pydantic_model).fetch(queryset)
+    return items
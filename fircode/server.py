@@ -0,0 +1,165 @@
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from typing import List, Optional
+
+import uvicorn
+
+from fircode import config
+from fircode.events import event_hub
+from fircode.startup import prepare_database
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _implementation(option: str, fast: str, default: str) -> str:
+    if option != "auto":
+        return option
+    return fast if importlib.util.find_spec(fast) is not None else default
+
+
+def _options() -> dict:
+    return {
+        "host": config.server_host,
+        "port": config.server_port,
+        "loop": _implementation(config.server_loop, "uvloop", "asyncio"),
+        "http": _implementation(config.server_http, "httptools", "h11"),
+        "backlog": config.server_backlog,
+        "timeout_keep_alive": config.server_keep_alive,
+        "timeout_graceful_shutdown": config.server_graceful_timeout,
+        "proxy_headers": config.server_proxy_headers,
+        "forwarded_allow_ips": config.forwarded_allow_ips,
+        "ssl_keyfile": config.ssl_keyfile,
+        "ssl_certfile": config.ssl_certfile,
+    }
+
+
+class Server(uvicorn.Server):
+    """Uvicorn server, which ends event streams as soon as it's asked to stop
+
+    Otherwise streams keep their connections open and the worker waits for them until the graceful timeout.
+    """
+
+    def __init__(self, config: uvicorn.Config, supervised: bool = False) -> None:
+        super().__init__(config)
+        self.supervised = supervised
+
+    async def serve(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets)
+
+    def handle_exit(self, sig: int, frame) -> None:
+        if self.supervised and sig == signal.SIGINT:
+            # Ctrl+C of a terminal reaches every worker, the supervisor sends a single SIGTERM instead
+            # (a SIGINT after it would skip the graceful shutdown)
+            return
+        if not self.should_exit and getattr(self, "_loop", None) is not None:
+            self._loop.call_soon_threadsafe(event_hub.close_streams)
+        super().handle_exit(sig, frame)
+
+
+def _bind(host: str, port: int, reuse_port: bool) -> socket.socket:
+    """Returns a bound socket, which isn't listening yet: the server listens after its startup"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _serve(app: str, options: dict, supervised: bool) -> None:
+    """Runs a worker (the target of worker processes)"""
+    server = Server(uvicorn.Config(app, **options), supervised=supervised)
+    server.run(sockets=[_bind(options["host"], options["port"], reuse_port=True)] if supervised else None)
+    if not server.started:
+        # Database connection threads, which startup opened, would keep the process alive
+        os._exit(3)
+
+
+class Supervisor:
+    """Starts workers with their own SO_REUSEPORT sockets and stops them gracefully
+
+    A worker, which exits by itself, stops the others too, so the process manager restarts the service.
+    """
+
+    def __init__(self, app: str, workers: int, options: dict) -> None:
+        self.app = app
+        self.workers = workers
+        self.options = options
+        self.processes: List[multiprocessing.Process] = []
+        self.should_exit = threading.Event()
+
+    def handle_exit(self, sig: int, frame) -> None:
+        self.should_exit.set()
+
+    def run(self) -> None:
+        # Fails before any worker starts, if the port is taken (SO_REUSEPORT would share it with
+        # another launcher of the same user)
+        try:
+            _bind(self.options["host"], self.options["port"], reuse_port=False).close()
+        except OSError as error:
+            logger.error(f"Can't bind {self.options['host']}:{self.options['port']}: {error}")
+            raise SystemExit(1)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_exit)
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.workers):
+            process = context.Process(target=_serve, args=(self.app, self.options, True))
+            process.start()
+            self.processes.append(process)
+        logger.info(f"Started {self.workers} workers (pids {', '.join(str(p.pid) for p in self.processes)})")
+
+        failed = False
+        while not self.should_exit.wait(0.5):
+            if any(not process.is_alive() for process in self.processes):
+                logger.error("A worker exited, stopping the others")
+                failed = True
+                break
+        self.stop()
+        if failed:
+            raise SystemExit(1)
+
+    def stop(self) -> None:
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        # Workers finish requests in flight and run shutdown handlers
+        deadline = time.monotonic() + config.server_graceful_timeout + 10
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {process.pid} didn't stop in time, killing it")
+                process.kill()
+                process.join()
+
+
+def run(app: str) -> None:
+    """Serves the app with config.server_workers workers"""
+    options = _options()
+    # Configures logging of this process too
+    uvicorn.Config(app, **options)
+    logger.info(f"Serving {app} on {config.server_host}:{config.server_port} "
+                f"with {options['loop']} loop and {options['http']} HTTP parser")
+
+    if config.server_reload:
+        uvicorn.run(app, **options, reload=True)
+    elif config.server_workers <= 1:
+        _serve(app, options, supervised=False)
+    else:
+        # Once here, otherwise every worker upgrades the schema on the first boot and they collide
+        asyncio.run(prepare_database())
+        if config.server_reuse_port and hasattr(socket, "SO_REUSEPORT"):
+            Supervisor(app, config.server_workers, options).run()
+        else:
+            uvicorn.run(app, **options, workers=config.server_workers)
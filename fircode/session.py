@@ -1,24 +1,123 @@
-from fircode.models import User, SessionToken, SignInRequest, UserResponse
-from bcrypt import checkpw
+from fircode.models import User, SessionToken, SignInRequest
+from fircode import config
+from fircode.password_hasher import password_hasher
+from fircode.cache import TTLCache
+from fircode.db_router import pin_to_primary
+import asyncio
+import hashlib
 import secrets
-from fastapi import Response, Request
+from dataclasses import dataclass
+from fastapi import Depends, Response, Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
+from fastapi.logger import logger
+from tortoise import timezone
 from fircode.config import session_token_lenght
 from tortoise.exceptions import DoesNotExist
 from fircode.config import debug
-from typing import Union
+from fircode.exceptions import PermissionDenied
+from typing import Annotated, Optional, Union
 import datetime
 from fircode.config import session_max_time
+from fircode.config import session_cache_size, session_cache_ttl
 
 
 session_responses = {
     401: {"description": "Authorization error. See detail->type"}
 }
 
+# token digest -> (Identity, expires_at)
+session_cache = TTLCache(max_size=session_cache_size, ttl=session_cache_ttl)
+_sweeper: Optional[asyncio.Task] = None
+
+
+def token_digest(token: str) -> str:
+    """Returns the stored form of a session token, so a database leak doesn't leak sessions"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def invalidate_user_sessions(email: str) -> None:
+    """Drop cached sessions of the user (call it after user changes)"""
+    session_cache.pop_where(lambda entry: entry[0].email == email)
+
+
+async def sweep_expired_sessions() -> int:
+    """Delete expired sessions by bounded batches, returns the number of deleted sessions"""
+    deleted = 0
+    while True:
+        tokens = await SessionToken.filter(expires_at__lte=timezone.now()) \
+            .limit(config.session_sweep_batch_size).values_list("token", flat=True)
+        if tokens:
+            deleted += await SessionToken.filter(token__in=tokens).delete()
+        if len(tokens) < config.session_sweep_batch_size:
+            return deleted
+
+
+async def start_sweeper() -> None:
+    """Sweep expired sessions in background every session_sweep_interval"""
+
+    async def sweep():
+        pin_to_primary()
+        while True:
+            try:
+                deleted = await sweep_expired_sessions()
+                if deleted:
+                    logger.info(f"Expired sessions deleted: {deleted}")
+            except Exception:
+                logger.exception("Expired sessions sweep failed")
+            await asyncio.sleep(config.session_sweep_interval)
+
+    global _sweeper
+    _sweeper = asyncio.create_task(sweep())
+
+
+async def stop_sweeper() -> None:
+    if _sweeper is not None:
+        _sweeper.cancel()
+
+
+@dataclass(frozen=True)
+class Identity:
+    """Authenticated user of a request, email is the User primary key"""
+    email: str
+    is_admin: bool
+
+
+async def get_current_user(request: Request) -> Identity:
+    """Resolves the session cookie with a single query (or none, if the session is cached)"""
+    if "session" not in request.cookies:
+        raise HTTPException(status_code=401, detail="Empty token")
+    digest = token_digest(request.cookies["session"])
+    now = timezone.now()
+    cached = session_cache.get(digest)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    lookup = SessionToken.filter(token=digest, expires_at__gt=now)
+    rows = await lookup.values("user_id", "user__is_admin", "expires_at")
+    if not rows:
+        # A replica may not have the session created right before this request yet
+        pin_to_primary()
+        rows = await lookup.values("user_id", "user__is_admin", "expires_at")
+        if not rows:
+            raise HTTPException(status_code=401, detail="Invalid token")
+    identity = Identity(email=rows[0]["user_id"], is_admin=rows[0]["user__is_admin"])
+    session_cache.set(digest, (identity, rows[0]["expires_at"]))
+    return identity
+
+
+async def get_admin_user(user: Identity = Depends(get_current_user)) -> Identity:
+    if not user.is_admin:
+        raise PermissionDenied()
+    return user
+
+
+# FastAPI resolves a dependency once per request, however many times the route asks for it
+CurrentUser = Annotated[Identity, Depends(get_current_user)]
+AdminUser = Annotated[Identity, Depends(get_admin_user)]
+
 
 class Session:
-    user: UserResponse
+    user: User
     token: str
 
     def __init__(self, token = None):
@@ -39,11 +138,12 @@ class Session:
                     }
                 })
 
-        if checkpw(request.password.encode("utf-8"), user.hashed_password.encode("utf-8")):
+        if await password_hasher.check(request.password, user.hashed_password):
             token = secrets.token_urlsafe(session_token_lenght)
             self.user = user
             self.token = token
-            await SessionToken.create(token=token, user=user)
+            await SessionToken.create(token=token_digest(token), user=user,
+                                      expires_at=timezone.now() + session_max_time)
             response = Response()
             expired_date = datetime.datetime.now(datetime.timezone.utc) + session_max_time
             if debug:
@@ -62,25 +162,14 @@ class Session:
                     }
                 })
 
-    async def get_from_request(self, request: Request) -> None:
-        if "session" in request.cookies:
-            try:
-                src_token = request.cookies["session"]
-                token = await SessionToken.get(token=src_token)
-                self.user = await UserResponse.from_queryset_single(token.user.get())
-                self.token = src_token
-            except DoesNotExist:
-                raise HTTPException(status_code=401, detail="Invalid token")
-
-        else:
-            raise HTTPException(status_code=401, detail="Empty token")
-
     @staticmethod
     async def close_session(request: Request) -> Response:
         response = Response()
         if "session" in request.cookies:
+            digest = token_digest(request.cookies["session"])
+            session_cache.pop(digest)
             try:
-                await SessionToken.filter(token=request.cookies["session"]).delete()
+                await SessionToken.filter(token=digest).delete()
                 response.delete_cookie("session")
             except DoesNotExist:
                 pass
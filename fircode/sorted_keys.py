@@ -0,0 +1,140 @@
+import random
+from typing import Any, Iterable, List, Optional, Sequence
+
+# Own generator, so tree shapes don't consume the global random sequence
+_random = random.Random()
+
+
+class _Node:
+    __slots__ = ("key", "left", "right", "size")
+
+    def __init__(self, key: Any) -> None:
+        self.key = key
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+        self.size = 1
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node) -> _Node:
+    node.size = 1 + _size(node.left) + _size(node.right)
+    return node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Joins two trees, all keys of the left one are smaller; the root is picked in proportion to sizes"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if _random.randrange(left.size + right.size) < left.size:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _split(node: Optional[_Node], key: Any):
+    """Returns trees of keys below the key and of the rest"""
+    if node is None:
+        return None, None
+    if node.key < key:
+        below, rest = _split(node.right, key)
+        node.right = below
+        return _update(node), rest
+    below, rest = _split(node.left, key)
+    node.left = rest
+    return below, _update(node)
+
+
+def _pop_first(node: _Node) -> Optional[_Node]:
+    if node.left is None:
+        return node.right
+    node.left = _pop_first(node.left)
+    return _update(node)
+
+
+def _build(keys: Sequence, start: int, stop: int) -> Optional[_Node]:
+    if start >= stop:
+        return None
+    middle = (start + stop) // 2
+    node = _Node(keys[middle])
+    node.left = _build(keys, start, middle)
+    node.right = _build(keys, middle + 1, stop)
+    return _update(node)
+
+
+class SortedKeys:
+    """Sorted keys with positions: add, remove, bisect and getting the i-th key take O(log n)
+
+    A randomized binary search tree, which keeps subtree sizes, the expected depth is O(log n)
+    whatever the order of changes is.
+    """
+
+    def __init__(self, keys: Iterable = ()) -> None:
+        keys = sorted(keys)
+        self._root = _build(keys, 0, len(keys))
+
+    def add(self, key: Any) -> None:
+        below, rest = _split(self._root, key)
+        self._root = _merge(_merge(below, _Node(key)), rest)
+
+    def remove(self, key: Any) -> None:
+        """Removes one occurrence of the key, raises ValueError if there is none"""
+        below, rest = _split(self._root, key)
+        first = rest
+        while first is not None and first.left is not None:
+            first = first.left
+        if first is None or first.key != key:
+            self._root = _merge(below, rest)
+            raise ValueError(f"{key!r} is not in keys")
+        self._root = _merge(below, _pop_first(rest))
+
+    def bisect_left(self, key: Any) -> int:
+        """Returns the number of keys below the key"""
+        index = 0
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                index += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return index
+
+    def __getitem__(self, index: slice) -> List:
+        """Keys of a slice (without step), it takes O(log n + the slice length)"""
+        start, stop, _ = index.indices(len(self))
+        # Path to the start key, nodes after it in order are pushed
+        stack: List[_Node] = []
+        node = self._root
+        offset = start
+        while node is not None and start < stop:
+            left = _size(node.left)
+            if offset < left:
+                stack.append(node)
+                node = node.left
+            elif offset == left:
+                stack.append(node)
+                break
+            else:
+                offset -= left + 1
+                node = node.right
+        keys = []
+        while stack and len(keys) < stop - start:
+            node = stack.pop()
+            keys.append(node.key)
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+        return keys
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __iter__(self):
+        return iter(self[:])
@@ -1,19 +1,172 @@
-from fastapi import FastAPI
+import asyncio
+import gzip
+import hashlib
+import mimetypes
 import os
-from typing import Tuple, Union
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Sequence, Tuple
+
+from fastapi.logger import logger
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Vite puts content hashed files there, so they never change under the same name
+immutable_prefix = "assets" + os.sep
+immutable_cache_control = "public, max-age=31536000, immutable"
+default_cache_control = "no-cache"
+compressible_types = ("text/", "application/javascript", "application/json", "image/svg+xml")
+min_compress_size = 1024
+
+
+def encoding_qualities(accept_encoding: str) -> Dict[str, float]:
+    """Returns q-values of the Accept-Encoding header by lowercase coding, "*" included"""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def choose_encoding(accept_encoding: str, available: Sequence[str]) -> Optional[str]:
+    """Returns the available coding with the highest q-value (the first one on a tie) or None"""
+    qualities = encoding_qualities(accept_encoding)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+@dataclass
+class StaticAsset:
+    full_path: str
+    stat_result: os.stat_result
+    etag: str
+    media_type: str
+    cache_control: str
+    # content-encoding -> (etag, body)
+    variants: Dict[str, Tuple[str, bytes]] = field(default_factory=dict)
+
+
+def _compress(content: bytes) -> Dict[str, bytes]:
+    variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content)
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(content)}
+
+
+def _read_asset(full_path: str, relative_path: str) -> StaticAsset:
+    with open(full_path, "rb") as file:
+        content = file.read()
+    stat_result = os.stat(full_path)
+    digest = hashlib.md5(content).hexdigest()
+    media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    asset = StaticAsset(
+        full_path=full_path,
+        stat_result=stat_result,
+        etag=f'"{digest}"',
+        media_type=media_type,
+        cache_control=immutable_cache_control if relative_path.startswith(immutable_prefix) else default_cache_control
+    )
+    if media_type.startswith(compressible_types) and len(content) >= min_compress_size:
+        for encoding, body in _compress(content).items():
+            asset.variants[encoding] = (f'"{digest}-{encoding}"', body)
+    return asset
 
 
 class SinglePageApplication(StaticFiles):
     """Acts similar to the bripkens/connect-history-api-fallback
     NPM package."""
 
-    def __init__(self, directory: os.PathLike, index='index.html') -> None:
+    def __init__(self, directory: os.PathLike, index='index.html', precompute: bool = False) -> None:
         self.index = index
+        self.precompute = precompute
+        self.assets: Dict[str, StaticAsset] = {}
+        self._watcher: Optional[asyncio.Task] = None
 
         # set html=True to resolve the index even when no
         # the base path is passed in
         super().__init__(directory=directory, packages=None, html=True, check_dir=True)
+        if precompute:
+            self.build_index()
+
+    def build_index(self) -> None:
+        """Scan the directory once, so requests are answered without filesystem lookups"""
+        assets = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                relative_path = os.path.relpath(full_path, self.directory)
+                assets[relative_path] = _read_asset(full_path, relative_path)
+        self.assets = assets
+        logger.info(f"Static index built: {len(assets)} files")
+
+    async def start_watching(self) -> None:
+        """Rebuild the index on changes in the directory (for development)"""
+        try:
+            from watchfiles import awatch
+        except ImportError:
+            logger.warning("watchfiles isn't installed, static index won't be rebuilt on changes")
+            return
+
+        async def watch():
+            async for _ in awatch(self.directory):
+                await asyncio.to_thread(self.build_index)
+
+        self._watcher = asyncio.create_task(watch())
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if not self.precompute:
+            return await super().get_response(path, scope)
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+
+        asset = self.assets.get(path) or self.assets.get(self.index)
+        if asset is None:
+            raise HTTPException(status_code=404)
+        request_headers = Headers(scope=scope)
+        headers = {"cache-control": asset.cache_control}
+        if asset.variants:
+            headers["vary"] = "Accept-Encoding"
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etags = {asset.etag} | {etag for etag, _ in asset.variants.values()}
+            requested = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            matched = etags & requested
+            if matched or "*" in requested:
+                headers["etag"] = matched.pop() if matched else asset.etag
+                return Response(status_code=304, headers=headers)
+
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""),
+                                   [encoding for encoding in ("br", "gzip") if encoding in asset.variants])
+        if encoding is not None:
+            etag, body = asset.variants[encoding]
+            headers.update({"etag": etag, "content-encoding": encoding})
+            return Response(body, media_type=asset.media_type, headers=headers)
+
+        headers["etag"] = asset.etag
+        return FileResponse(asset.full_path, stat_result=asset.stat_result, media_type=asset.media_type,
+                            headers=headers)
 
     def lookup_path(self, path: str) -> Tuple[str, os.stat_result]:
         """Returns the index file when no match is found.
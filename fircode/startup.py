@@ -1,35 +1,207 @@
+import functools
+import hashlib
+import inspect
+import logging
+import time
+from typing import Callable, List, Optional, Tuple
+
 from fastapi import FastAPI
-from fastapi.logger import logger
+from tortoise import Tortoise, connections, timezone
 from tortoise.contrib.fastapi import register_tortoise
+from tortoise.exceptions import IntegrityError, OperationalError
+from tortoise.transactions import in_transaction
+from tortoise.utils import generate_schema_for_client, get_schema_sql
 
 from fircode import config
 from fircode import user_utils
+from fircode.db_router import pin_to_primary
+from fircode.dog_search import dog_search, schema_sql
 from fircode.exceptions import UserAlreadyExists
 from fircode.models import *
+from fircode.password_hasher import password_hasher
+from fircode.serialization import projection_for
+from fircode.session import token_digest
+
+# fastapi's logger has no handler under uvicorn, startup reports go to uvicorn's log instead
+logger = logging.getLogger("uvicorn.error")
 
 
 def initialize_database(app: FastAPI):
     """Initialize database (sqlite/postgres)"""
-    if not config.sqlite_mode:
-        register_tortoise(
-            app,
-            config=config.tortoise_config,
-            generate_schemas=True,
-            add_exception_handlers=True
-        )
+    register_tortoise(
+        app,
+        config=config.tortoise_config,
+        generate_schemas=False,
+        add_exception_handlers=True
+    )
+    app.router.on_startup.append(create_schemas)
+
+
+def schema_fingerprint() -> str:
+    """Returns hash of the schema SQL, it changes with the models"""
+    connection = connections.get(config.primary_connection)
+    schema = get_schema_sql(connection, safe=True) + schema_sql(connection.capabilities.dialect)
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()
+
+
+async def _stored_fingerprint() -> Optional[str]:
+    try:
+        return await SchemaVersion.filter(id=1).first().values_list("fingerprint", flat=True)
+    except OperationalError:
+        # No schema_version table yet
+        return None
+
+
+async def create_schemas() -> None:
+    """Upgrade tables of older versions and create missing ones, if the models changed"""
+    pin_to_primary()
+    fingerprint = schema_fingerprint()
+    if config.schema_version_check and await _stored_fingerprint() == fingerprint:
+        logger.info("Database schema is up to date")
     else:
-        register_tortoise(
-            app,
-            db_url="sqlite://database.sqlite3",
-            modules={"shelter": ["fircode.models"]},
-            generate_schemas=True,
-            add_exception_handlers=True
-        )
+        # Must run first: sqlite would index a missing column as a string literal
+        await upgrade_session_tokens()
+        await upgrade_feed_requests()
+        for connection in connections.all():
+            if connection.connection_name not in config.read_only_connections:
+                await generate_schema_for_client(connection, safe=True)
+        await dog_search.create_index()
+        try:
+            await SchemaVersion.update_or_create(id=1, defaults={"fingerprint": fingerprint})
+        except IntegrityError:
+            # Stored by another worker, which generated the same schema
+            pass
+        logger.info("Database schema generated")
+    await dog_search.detect()
+
+
+async def prepare_database() -> None:
+    """Upgrade and create tables before workers are started, so they don't do it concurrently on first boot
+
+    Workers still check the schema on startup, but they find it up to date.
+    """
+    await Tortoise.init(config=config.tortoise_config)
+    try:
+        await create_schemas()
+    finally:
+        await Tortoise.close_connections()
+
+
+async def warm_up() -> None:
+    """Open database connections and build serializers, so the first requests don't pay for them"""
+    for connection in connections.all():
+        # Pools of asyncpg are created with their minimal size on the first query
+        await connection.execute_query("SELECT 1")
+    for pydantic_model in (DogOut, FeedRequestResponse, UserResponse, UserResponseForStat):
+        projection_for(pydantic_model)
+    await password_hasher.warm_up()
+
+
+def time_startup(app: FastAPI) -> None:
+    """Log how long every startup handler took (call it after all handlers are added)"""
+    phases: List[Tuple[str, float]] = []
+
+    def timed(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        async def run() -> None:
+            started = time.perf_counter()
+            result = handler()
+            if inspect.isawaitable(result):
+                await result
+            phases.append((handler.__qualname__.split("<locals>.")[-1], time.perf_counter() - started))
+        return run
+
+    async def report() -> None:
+        total = sum(duration for _, duration in phases)
+        logger.info("Startup: " + ", ".join(f"{name} {duration * 1000:.1f} ms" for name, duration in phases)
+                    + f", total {total * 1000:.1f} ms")
+
+    app.router.on_startup[:] = [timed(handler) for handler in app.router.on_startup] + [report]
+
+
+async def _table_columns(table: str) -> set:
+    connection = connections.get(config.primary_connection)
+    if connection.capabilities.dialect == "sqlite":
+        rows = await connection.execute_query_dict(f'PRAGMA table_info("{table}")')
+    else:
+        rows = await connection.execute_query_dict(
+            "SELECT column_name AS name FROM information_schema.columns WHERE table_name = $1", [table])
+    return {row["name"] for row in rows}
+
+
+async def _add_missing_columns(model, names) -> bool:
+    """Adds columns of the model, which the table doesn't have, returns false if there is no table yet"""
+    connection = connections.get(config.primary_connection)
+    meta = model._meta
+    columns = await _table_columns(meta.db_table)
+    if not columns:
+        return False
+    for name in names:
+        column = meta.fields_db_projection[name]
+        if column in columns:
+            continue
+        sql_type = meta.fields_map[name].get_for_dialect(connection.capabilities.dialect, "SQL_TYPE")
+        try:
+            await connection.execute_script(f'ALTER TABLE "{meta.db_table}" ADD COLUMN "{column}" {sql_type}')
+        except OperationalError:
+            # Another worker, which upgrades at the same time, may have added it
+            if column not in await _table_columns(meta.db_table):
+                raise
+    return True
+
+
+async def upgrade_session_tokens() -> None:
+    """Upgrade sessions created before tokens were hashed and expired
+
+    Adds the expiry columns and replaces raw tokens with their digests, so existing cookies keep working.
+    """
+    if not await _add_missing_columns(SessionToken, ("created_at", "expires_at")):
+        return
+
+    connection = connections.get(config.primary_connection)
+    placeholder = "$1" if connection.capabilities.dialect == "postgres" else "?"
+    upgraded = 0
+    now = timezone.now()
+    while True:
+        # A batch is replaced atomically and digests, which another worker inserted, are skipped,
+        # so an interrupted or concurrent upgrade is finished by the next one
+        async with in_transaction(config.primary_connection) as transaction:
+            rows = await SessionToken.filter(expires_at__isnull=True) \
+                .limit(config.session_sweep_batch_size).values_list("token", "user_id")
+            if rows:
+                # The primary key can't be updated, so the digests are inserted as new rows
+                await SessionToken.bulk_create([
+                    SessionToken(token=token_digest(token), user_id=user_id, created_at=now,
+                                 expires_at=now + config.session_max_time)
+                    for token, user_id in rows
+                ], ignore_conflicts=True)
+                # Raw tokens are longer than the token field allows, so a filter() would reject them
+                await transaction.execute_many(
+                    f'DELETE FROM "session_token" WHERE "token" = {placeholder}', [[token] for token, _ in rows])
+        upgraded += len(rows)
+        if len(rows) < config.session_sweep_batch_size:
+            break
+    if upgraded:
+        logger.info(f"Sessions upgraded to hashed tokens: {upgraded}")
+
+
+async def upgrade_feed_requests() -> None:
+    """Add idempotency keys to feed requests of older versions"""
+    if not await _add_missing_columns(FeedRequest, ("idempotency_key",)):
+        return
+    connection = connections.get(config.primary_connection)
+    # New tables get the same constraint from unique_together
+    await connection.execute_script(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "uid_feedrequest_actor_idempotency_key" '
+        'ON "feedrequest" ("actor_id", "idempotency_key")'
+    )
 
 
 async def database_setup() -> None:
     """Pull necessary data to database on first startup"""
     """Create admin account, if it doesn't exist"""
+    # Replicas may lag behind or be empty on the first startup
+    pin_to_primary()
     try:
         await user_utils.create_user(
             email=config.admin_email,
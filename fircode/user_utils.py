@@ -1,17 +1,16 @@
-from fircode import config
-import bcrypt
+from tortoise.exceptions import IntegrityError
+
 from fircode.models import User
 from fircode.exceptions import UserAlreadyExists
-from tortoise.exceptions import DoesNotExist
+from fircode.leaderboard import leaderboard
+from fircode.password_hasher import password_hasher
+from fircode.response_cache import dog_cache
+from fircode.session import invalidate_user_sessions
 
 
 async def is_user_exists(email: str) -> bool:
     """Returns true, if an user exists"""
-    try:
-        await User.get(email=email)
-        return True
-    except DoesNotExist:
-        return False
+    return await User.exists(email=email)
 
 
 async def create_user(
@@ -24,30 +23,43 @@ async def create_user(
         contribution=0
     ) -> None:
     """Create a new account for an user"""
-    salt: bytes = bcrypt.gensalt(config.bcrypt_rounds)
-    hashed_password: bytes = bcrypt.hashpw(bytes(password, "utf-8"), salt)
+    # Check first, so existing accounts (e.g. the admin on every startup) don't cost a bcrypt hash
     if await is_user_exists(email=email):
         raise UserAlreadyExists
     else:
-        await User.create(
-            email=email,
-            phone=phone,
-            hashed_password=hashed_password.decode("utf-8"),
-            first_name=first_name,
-            second_name=second_name,
-            contribution=contribution,
-            is_admin=is_admin
-        )
+        hashed_password: str = await password_hasher.hash(password)
+        try:
+            await User.create(
+                email=email,
+                phone=phone,
+                hashed_password=hashed_password,
+                first_name=first_name,
+                second_name=second_name,
+                contribution=contribution,
+                is_admin=is_admin
+            )
+        except IntegrityError:
+            # Created concurrently, e.g. the admin by another worker on the first startup
+            raise UserAlreadyExists
+        leaderboard.set(email, contribution)
 
 
 async def change_user_password(email: str, new_password: str) -> None:
     """Change an admin password without an old password check"""
-    salt: bytes = bcrypt.gensalt(config.bcrypt_rounds)
-    new_hashed_password: bytes = bcrypt.hashpw(bytes(new_password, "utf-8"), salt)
-    await User.filter(email=email).update(password_hash=str(new_hashed_password))
+    new_hashed_password: str = await password_hasher.hash(new_password)
+    await User.filter(email=email).update(hashed_password=new_hashed_password)
+
+
+async def set_user_admin(email: str, is_admin: bool) -> None:
+    """Grant or revoke admin permissions"""
+    await User.filter(email=email).update(is_admin=is_admin)
+    invalidate_user_sessions(email)
 
 
 async def delete_user(email: str) -> None:
     """Delete an user account"""
     await User.filter(email=email).delete()
+    invalidate_user_sessions(email)
+    leaderboard.remove(email)
+    dog_cache.invalidate()
 
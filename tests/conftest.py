@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+root = Path(__file__).resolve().parents[1]
+workdir = tempfile.mkdtemp(prefix="fircode-tests-")
+
+# Must be set before fircode.config is imported
+os.environ.update({
+    "debug": "False",
+    "USE_SQLITE": "True",
+    "SQLITE_PATH": os.path.join(workdir, "tests.sqlite3"),
+    "MEDIA_DIR": os.path.join(workdir, "media"),
+    "RATE_LIMIT_PATH": os.path.join(workdir, "rate-limit"),
+    "ADMIN_USERNAME": "admin@example.com",
+    "ADMIN_PASSWORD": "admin",
+    "BCRYPT_ROUNDS": "4",
+})
+# The app serves frontend/ relative to the working directory
+os.chdir(root)
+sys.path.insert(0, str(root))
+
+
+@pytest.fixture
+def own_connections():
+    """For tests, which init Tortoise with their own connections
+
+    Tortoise merges connections of every init into the config of the first one, which may be config.db_connections
+    of the app, so it's restored afterwards.
+    """
+    from fircode import config
+
+    saved = dict(config.db_connections)
+    yield
+    config.db_connections.clear()
+    config.db_connections.update(saved)
@@ -0,0 +1,475 @@
+"""Endpoint benchmark: boots fircode.main:app in-process against a seeded SQLite database
+
+    poetry run tests --users 1000 --dogs 300 --feed-requests 5000 --output bench.json
+    poetry run tests --compare bench.json --output new.json
+    SQLITE_PROFILE=default poetry run tests --routes "GET /feed_requests" --concurrency 16 --write-load 50
+
+Every route of api_app is measured (p50/p99 latency, throughput, DB queries per request).
+Routes without a scenario are reported as skipped, so a new endpoint doesn't go unnoticed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+root = Path(__file__).resolve().parents[1]
+user_password = "password"
+# Set in write load tasks, so their queries aren't counted for the measured route
+background: ContextVar[bool] = ContextVar("background", default=False)
+
+
+class QueryCounter(logging.Handler):
+    """Counts queries logged by tortoise database clients"""
+
+    def __init__(self) -> None:
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if background.get():
+            return
+        if record.msg == "%s: %s" or record.args == ():
+            self.count += 1
+
+
+@dataclass
+class Scenario:
+    method: str
+    path: str
+    # None, "user" or "admin"
+    auth: Optional[str] = None
+    # Returns httpx request kwargs (url, json, content, ...) for the i-th call, it runs before timing
+    prepare: Optional[Callable[["Context", int], Awaitable[Dict[str, Any]]]] = None
+    requests: Optional[int] = None
+    # Upper bound of average queries per request, it must not grow with the table size
+    max_queries: Optional[float] = None
+
+
+@dataclass
+class Context:
+    users: int
+    dogs: int
+    feed_requests: int
+    cookies: Dict[str, Any] = field(default_factory=dict)
+    values: Dict[str, Any] = field(default_factory=dict)
+    counter: itertools.count = field(default_factory=itertools.count)
+
+
+async def seed(context: Context) -> None:
+    """Fill the database with users, dogs and feed requests"""
+    from fircode.allocation import allocator
+    from fircode.leaderboard import leaderboard
+    from fircode.models import Dog, FeedRequest, Gender, User
+    from fircode.password_hasher import password_hasher
+
+    hashed_password = await password_hasher.hash(user_password)
+    await User.bulk_create([
+        User(email=f"user{i}@example.com", phone="+79000000000", first_name="Пользователь", second_name=str(i),
+             is_admin=False, hashed_password=hashed_password, contribution=random.randint(0, 1000))
+        for i in range(context.users)
+    ], batch_size=1000)
+    await Dog.bulk_create([
+        Dog(name=f"Собака {i}", age=random.randint(1, 15), description="Дружелюбная, симпатичная",
+            gender=random.choice(list(Gender)), feed_amount=random.randint(0, 100),
+            host_id=f"user{i}@example.com" if i % 5 == 0 and i < context.users else None)
+        for i in range(context.dogs)
+    ], batch_size=1000)
+    dog_ids = await Dog.all().values_list("id", flat=True)
+    await FeedRequest.bulk_create([
+        FeedRequest(actor_id=f"user{random.randrange(context.users)}@example.com", target_id=random.choice(dog_ids),
+                    feed_amount=random.randint(1, 10), arrived_at=date(2024, 1 + i % 12, 1 + i % 28))
+        for i in range(context.feed_requests)
+    ], batch_size=1000)
+    context.values["dog_ids"] = dog_ids
+    await leaderboard.rebuild()
+    await allocator.rebuild()
+
+
+async def create_feed_request(actor: str = "user0@example.com") -> int:
+    from fircode.models import Dog, FeedRequest
+
+    dog = await Dog.first()
+    feed_request = await FeedRequest.create(actor_id=actor, target_id=dog.id, feed_amount=1,
+                                            arrived_at=date.today())
+    return feed_request.id
+
+
+async def create_dog() -> int:
+    from fircode.models import Dog, Gender
+
+    dog = await Dog.create(name="Временная", age=1, description="Для удаления", gender=Gender.female)
+    return dog.id
+
+
+async def prepare_registration(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/registration", "json": {
+        "email": f"new{next(context.counter)}@example.com", "phone_number": "+79000000000",
+        "first_name": "Новый", "second_name": "Пользователь", "password": user_password}}
+
+
+async def prepare_login(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/login", "json": {"email": "user0@example.com", "password": user_password}}
+
+
+async def prepare_logout(context: Context, i: int) -> Dict[str, Any]:
+    from fircode.session import Session
+    from fircode.models import SignInRequest
+
+    response = await Session().create_session(SignInRequest(email="user1@example.com", password=user_password))
+    token = response.headers["set-cookie"].split(";")[0].split("=", 1)[1]
+    return {"url": "/logout", "cookies": {"session": token}}
+
+
+async def prepare_dog(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/dog/{random.choice(context.values['dog_ids'])}"}
+
+
+async def prepare_dog_stats(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/stats/dogs/{random.choice(context.values['dog_ids'])}"}
+
+
+async def prepare_add_dog(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/dog", "json": {"name": "Новая", "photo": "dog_photo.png", "gender": "male", "age": 2,
+                                    "description": "Добавлена бенчмарком", "feed_amount": 0}}
+
+
+async def prepare_update_dog(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/dog", "json": {"id": random.choice(context.values["dog_ids"]), "name": "Обновлённая",
+                                    "photo": "dog_photo.png", "gender": "female", "age": 3,
+                                    "description": "Обновлена бенчмарком", "feed_amount": 5}}
+
+
+async def prepare_delete_dog(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/dog/{await create_dog()}"}
+
+
+async def prepare_upload_photo(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/dog/{random.choice(context.values['dog_ids'])}/photo",
+            "content": (root / "frontend" / "assets" / "dog-BVYFT2-N.png").read_bytes(),
+            "headers": {"content-type": "image/png"}}
+
+
+async def prepare_photo(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/photos/{context.values['photo']}"}
+
+
+async def prepare_add_feed_request(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/feed_request", "json": {"target_id": random.choice(context.values["dog_ids"]),
+                                             "feed_amount": 3, "arrived_at": date.today().isoformat()}}
+
+
+async def prepare_approve(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": "/feed_requests/approve", "json": {"id": await create_feed_request(), "approved": True,
+                                                      "award": 1}}
+
+
+async def prepare_approve_bulk(context: Context, i: int) -> Dict[str, Any]:
+    ids = [await create_feed_request(f"user{j % context.users}@example.com") for j in range(20)]
+    return {"url": "/feed_requests/approve_bulk",
+            "json": [{"id": request_id, "approved": True, "award": 1} for request_id in ids]}
+
+
+async def prepare_delete_feed_request(context: Context, i: int) -> Dict[str, Any]:
+    return {"url": f"/feed_requests/{await create_feed_request()}"}
+
+
+async def prepare_import(context: Context, i: int) -> Dict[str, Any]:
+    rows = [json.dumps({"actor_id": f"user{j % context.users}@example.com",
+                        "target_id": random.choice(context.values["dog_ids"]), "feed_amount": 1,
+                        "arrived_at": date.today().isoformat()}) for j in range(500)]
+    return {"url": "/import/feed_requests", "content": "\n".join(rows).encode("utf-8"),
+            "headers": {"content-type": "application/x-ndjson"}}
+
+
+def simple(url: str, **kwargs) -> Callable[[Context, int], Awaitable[Dict[str, Any]]]:
+    async def prepare(context: Context, i: int) -> Dict[str, Any]:
+        return {"url": url, **kwargs}
+    return prepare
+
+
+scenarios: List[Scenario] = [
+    Scenario("GET", "/hasher_stats", auth="admin", prepare=simple("/hasher_stats")),
+    Scenario("GET", "/session_cache_stats", auth="admin", prepare=simple("/session_cache_stats")),
+    Scenario("GET", "/dog_cache_stats", auth="admin", prepare=simple("/dog_cache_stats")),
+    Scenario("GET", "/metrics", auth="admin", prepare=simple("/metrics")),
+    Scenario("POST", "/registration", prepare=prepare_registration),
+    Scenario("POST", "/login", prepare=prepare_login),
+    Scenario("GET", "/user", auth="user", prepare=simple("/user")),
+    Scenario("GET", "/users_stat", prepare=simple("/users_stat"), max_queries=2),
+    Scenario("GET", "/users_stat/top", prepare=simple("/users_stat/top")),
+    Scenario("GET", "/users_stat/me", auth="user", prepare=simple("/users_stat/me")),
+    Scenario("GET", "/users_stat/around_me", auth="user", prepare=simple("/users_stat/around_me")),
+    Scenario("GET", "/stats/daily", auth="admin", prepare=simple("/stats/daily"), max_queries=1),
+    Scenario("GET", "/stats/dogs/{dog_id}", auth="admin", prepare=prepare_dog_stats, max_queries=1),
+    Scenario("GET", "/stats/users/me", auth="user", prepare=simple("/stats/users/me"), max_queries=1),
+    Scenario("GET", "/stats/users/{email}", auth="admin", prepare=simple("/stats/users/user0@example.com"),
+             max_queries=1),
+    Scenario("POST", "/logout", prepare=prepare_logout),
+    Scenario("GET", "/dogs", prepare=simple("/dogs"), max_queries=1),
+    Scenario("GET", "/dogs/search", prepare=simple("/dogs/search", params={"q": "соба", "min_age": 2}),
+             max_queries=1),
+    Scenario("GET", "/dogs/allocation", prepare=simple("/dogs/allocation", params={"units": 50, "max_dogs": 10}),
+             max_queries=1),
+    Scenario("GET", "/dog/{dog_id}", prepare=prepare_dog, max_queries=1),
+    Scenario("POST", "/dog", auth="admin", prepare=prepare_add_dog),
+    Scenario("PUT", "/dog", auth="admin", prepare=prepare_update_dog),
+    Scenario("DELETE", "/dog/{dog_id}", auth="admin", prepare=prepare_delete_dog),
+    Scenario("PUT", "/dog/{dog_id}/photo", auth="admin", prepare=prepare_upload_photo),
+    Scenario("GET", "/photos/{name}", prepare=prepare_photo),
+    Scenario("GET", "/feed_requests", prepare=simple("/feed_requests"), max_queries=1),
+    Scenario("GET", "/feed_requests/current", auth="user", prepare=simple("/feed_requests/current"), max_queries=2),
+    Scenario("POST", "/feed_request", auth="user", prepare=prepare_add_feed_request),
+    Scenario("POST", "/feed_requests/approve", auth="admin", prepare=prepare_approve),
+    Scenario("POST", "/feed_requests/approve_bulk", auth="admin", prepare=prepare_approve_bulk),
+    Scenario("DELETE", "/feed_requests/{request_id}", auth="user", prepare=prepare_delete_feed_request),
+    Scenario("POST", "/import/{kind}", auth="admin", prepare=prepare_import),
+    Scenario("GET", "/export/{kind}", auth="admin", prepare=simple("/export/feed_requests", params={"format": "csv"})),
+]
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent))]
+
+
+async def write_load(client, context: Context, rate: float, stop: asyncio.Event) -> int:
+    """Adds and deletes a feed request of another user rate times per second until stopped
+
+    The rate is fixed, so profiles are compared under the same load, and tables don't grow,
+    so read results stay the same size. Returns the number of writes.
+    """
+    background.set(True)
+
+    async def write() -> None:
+        response = await client.post("/feed_request", cookies=context.cookies["writer"],
+                                     json={"target_id": random.choice(context.values["dog_ids"]), "feed_amount": 1,
+                                           "arrived_at": date.today().isoformat()})
+        await client.delete(f"/feed_requests/{response.json()['id']}", cookies=context.cookies["writer"])
+
+    tasks = []
+    while not stop.is_set():
+        tasks.append(asyncio.create_task(write()))
+        try:
+            await asyncio.wait_for(stop.wait(), 1 / rate)
+        except asyncio.TimeoutError:
+            pass
+    await asyncio.gather(*tasks)
+    return len(tasks) * 2
+
+
+async def run_scenario(client, context: Context, scenario: Scenario, requests: int, concurrency: int,
+                       counter: QueryCounter, write_rate: float = 0) -> Dict[str, Any]:
+    """Runs the scenario, reads (GET) run alongside write_load, if write_rate is set"""
+    prepared = [await scenario.prepare(context, i) for i in range(requests)]
+    cookies = context.cookies.get(scenario.auth)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(kwargs: Dict[str, Any]) -> None:
+        kwargs = dict(kwargs)
+        request_cookies = kwargs.pop("cookies", cookies)
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(scenario.method, cookies=request_cookies, **kwargs)
+            latencies.append(time.perf_counter() - started)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    if scenario.method != "GET":
+        write_rate = 0
+    stop = asyncio.Event()
+    writer = asyncio.create_task(write_load(client, context, write_rate, stop)) if write_rate else None
+    counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(call(kwargs) for kwargs in prepared))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    writes = await writer if writer else 0
+    result = {
+        "requests": requests,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "throughput_rps": requests / elapsed,
+        "queries_per_request": counter.count / requests,
+        "max_queries": scenario.max_queries,
+    }
+    if writer:
+        result["writes_per_second"] = writes / elapsed
+    return result
+
+
+async def login(client, email: str, password: str):
+    response = await client.post("/login", json={"email": email, "password": password})
+    response.raise_for_status()
+    return response.cookies
+
+
+async def benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+    from asgi_lifespan import LifespanManager
+    from fastapi.routing import APIRoute
+
+    from fircode import config
+    from fircode.main import app, api_app
+
+    counter = QueryCounter()
+    db_logger = logging.getLogger("tortoise.db_client")
+    db_logger.setLevel(logging.DEBUG)
+    db_logger.addHandler(counter)
+    db_logger.propagate = False
+
+    context = Context(users=args.users, dogs=args.dogs, feed_requests=args.feed_requests)
+    results: Dict[str, Any] = {}
+    async with LifespanManager(app):
+        await seed(context)
+        transport = httpx.ASGITransport(app=api_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            context.cookies["user"] = await login(client, "user0@example.com", user_password)
+            context.cookies["admin"] = await login(client, config.admin_email, config.admin_password)
+            context.cookies["writer"] = await login(client, "user1@example.com", user_password)
+            upload = await client.request(**{"method": "PUT", "cookies": context.cookies["admin"],
+                                             **await prepare_upload_photo(context, 0)})
+            context.values["photo"] = upload.json()["photo"]
+
+            known = {(scenario.method, scenario.path): scenario for scenario in scenarios}
+            for route in api_app.routes:
+                if not isinstance(route, APIRoute):
+                    continue
+                for method in sorted(route.methods):
+                    name = f"{method} {route.path}"
+                    if args.routes and not any(pattern in name for pattern in args.routes):
+                        continue
+                    scenario = known.get((method, route.path))
+                    if scenario is None:
+                        results[name] = {"skipped": "no scenario"}
+                        continue
+                    requests = scenario.requests or args.requests
+                    results[name] = await run_scenario(client, context, scenario, requests, args.concurrency,
+                                                       counter, args.write_load)
+                    print(f"{name:45} p50 {results[name]['p50_ms']:8.2f} ms  p99 {results[name]['p99_ms']:8.2f} ms"
+                          f"  {results[name]['throughput_rps']:8.1f} rps"
+                          f"  {results[name]['queries_per_request']:6.2f} q/req"
+                          + (f"  {results[name]['writes_per_second']:8.1f} writes/s"
+                             if "writes_per_second" in results[name] else ""), file=sys.stderr)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def over_budget(results: Dict[str, Any]) -> List[str]:
+    """Returns descriptions of routes, which run more queries than their budget"""
+    return [f"{name}: {result['queries_per_request']:.2f} queries per request, budget {result['max_queries']}"
+            for name, result in results.items()
+            if result.get("max_queries") is not None and result["queries_per_request"] > result["max_queries"]]
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns descriptions of routes, which became slower or run more queries"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("routes", {}).get(name)
+        if not old or "skipped" in old or "skipped" in result:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if old[metric] > 0 and result[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {old[metric]:.2f} -> {result[metric]:.2f}")
+        if result["queries_per_request"] > old["queries_per_request"]:
+            regressions.append(f"{name}: queries per request "
+                               f"{old['queries_per_request']:.2f} -> {result['queries_per_request']:.2f}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark every api_app route in-process")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--dogs", type=int, default=100)
+    parser.add_argument("--feed-requests", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=50, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--write-load", type=float, default=0,
+                        help="feed requests added and deleted per second while GET routes are measured")
+    parser.add_argument("--routes", nargs="*", help="benchmark only routes containing these substrings")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed latency growth for --compare")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="fircode-benchmark-")
+    # Must be set before fircode.config is imported
+    os.environ.update({
+        "debug": "False",
+        "USE_SQLITE": "True",
+        "SQLITE_PATH": os.path.join(workdir, "benchmark.sqlite3"),
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+        "RATE_LIMIT_PATH": os.path.join(workdir, "rate-limit"),
+    })
+    # Every benchmark request comes from one client, keep the limiter on the path without rejecting it
+    for name in ("LOGIN_IP_LIMIT", "LOGIN_EMAIL_LIMIT", "REGISTRATION_IP_LIMIT", "REGISTRATION_EMAIL_LIMIT"):
+        os.environ.setdefault(name, "1000000")
+    os.environ.setdefault("ADMIN_USERNAME", "admin@example.com")
+    os.environ.setdefault("ADMIN_PASSWORD", "admin")
+    # The app serves frontend/ relative to the working directory
+    os.chdir(root)
+    sys.path.insert(0, str(root))
+
+    routes = asyncio.run(benchmark(args))
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "users": args.users,
+            "dogs": args.dogs,
+            "feed_requests": args.feed_requests,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "write_load": args.write_load,
+            "sqlite_profile": os.environ.get("SQLITE_PROFILE", "production"),
+        },
+        "routes": routes,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+
+    regressions = over_budget(routes)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions += compare(json.load(file), routes, args.threshold)
+    for regression in regressions:
+        print("regression:", regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+from fircode.allocation import Allocator
+
+
+def test_allocation_raises_hungriest_dogs():
+    allocator = Allocator(refresh_interval=60)
+    # Levels: dog 1 is at 10, dog 2 at 0 + 2 pending, dog 3 at 5
+    allocator.load([(1, 10), (2, 0), (3, 5)], [(2, 2)])
+    assert allocator.allocate(3, max_dogs=3) == [(2, 3)]
+    assert allocator.allocate(10, max_dogs=3) == [(2, 7), (3, 3)]
+    assert allocator.allocate(10, max_dogs=1) == [(2, 10)]
+    assert allocator.allocate(0, max_dogs=3) == []
+
+
+def test_allocation_follows_updates():
+    allocator = Allocator(refresh_interval=60)
+    allocator.load([(1, 10), (2, 0), (3, 5)], [(2, 2)])
+    allocator.approve(2, 2)
+    assert allocator.level(2) == (2, 0)
+    allocator.add_pending(3, 10)
+    allocator.set_feed_amount(4, 20)
+    assert allocator.allocate(1, max_dogs=1) == [(2, 1)]
+    allocator.remove(2)
+    assert allocator.allocate(1, max_dogs=1) == [(1, 1)]
+    allocator.add_pending(1, 8)
+    assert allocator.allocate(1, max_dogs=1) == [(3, 1)]
+    assert allocator.level(3) == (5, 10)
+    assert len(allocator) == 3
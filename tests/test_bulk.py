@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from asgi_lifespan import LifespanManager
+
+from fircode.bulk import _csv_rows, _lines, _ndjson_rows
+from tests.main import login
+
+csv_body = (
+    # Excel puts a byte order mark first
+    "\ufeffname,gender,age,description\n"
+    "Шарик,male,5,\"Дружелюбный,\n"
+    "симпатичный\"\n"
+    "\n"
+    "Бобик,male,7\n"
+    "Маня,female,6,\"Игривая\"\n"
+    "Жучка,female,2,\"не закрыта\n"
+).encode("utf-8")
+
+ndjson_body = (
+    '{"name": "Шарик", "age": 5}\n'
+    '\n'
+    '{"name": \n'
+    '[1, 2]\n'
+    '{"name": "Маня"}'
+).encode("utf-8")
+
+
+def parse(parser, body: bytes, chunk_size: int) -> list:
+    async def chunks():
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    async def main() -> list:
+        return [row async for row in parser(_lines(chunks()))]
+
+    return asyncio.run(main())
+
+
+# Chunk boundaries split lines, quoted fields and UTF-8 characters
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1024])
+def test_csv_rows(chunk_size):
+    assert parse(_csv_rows, csv_body, chunk_size) == [
+        (2, {"name": "Шарик", "gender": "male", "age": "5", "description": "Дружелюбный,\nсимпатичный"}),
+        (5, "Expected 4 columns, got 3"),
+        (6, {"name": "Маня", "gender": "female", "age": "6", "description": "Игривая"}),
+        (7, "Unterminated quoted field"),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_ndjson_rows(chunk_size):
+    assert parse(_ndjson_rows, ndjson_body, chunk_size) == [
+        (1, {"name": "Шарик", "age": 5}),
+        (3, "Invalid JSON"),
+        (4, "Row must be a JSON object"),
+        (5, {"name": "Маня"}),
+    ]
+
+
+def test_import_reports_rejected_rows():
+    async def main() -> None:
+        from fircode import config
+        from fircode.main import api_app, app
+
+        async with LifespanManager(app):
+            transport = httpx.ASGITransport(app=api_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                cookies = await login(client, config.admin_email, config.admin_password)
+                body = (
+                    "name,gender,age,description,host_id\n"
+                    "Импорт 1,male,5,Первый,\n"
+                    "Импорт 2,cat,5,Не собака,\n"
+                    "Импорт 3,female,old,Без возраста,\n"
+                    "Импорт 4,female,3,Без хозяина,nobody@example.com\n"
+                    "Импорт 5,female,4,Последний,\n"
+                )
+                response = await client.post("/import/dogs", content=body.encode("utf-8"), cookies=cookies,
+                                             headers={"Content-Type": "text/csv"})
+                assert response.status_code == 200
+                result = response.json()
+                assert (result["inserted"], result["failed"]) == (2, 3)
+                assert [error["line"] for error in result["errors"]] == [3, 4, 5]
+                assert result["errors"][0]["error"].startswith("gender:")
+                assert result["errors"][1]["error"].startswith("age:")
+                assert result["errors"][2]["error"] == "Host doesn't exist"
+
+                response = await client.post("/import/dogs", content=b"{}", cookies=cookies,
+                                             headers={"Content-Type": "application/json"})
+                assert response.status_code == 415
+
+                response = await client.get("/export/dogs", params={"format": "ndjson"}, cookies=cookies)
+                names = {json.loads(line)["name"] for line in response.text.splitlines()}
+                assert {"Импорт 1", "Импорт 5"} <= names
+                assert "Импорт 2" not in names
+
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""Read/write routing against two local SQLite files standing in for a primary and its replica
+
+The replica file is written directly and never synchronized, so a read shows where it was routed to.
+"""
+import asyncio
+import itertools
+import os
+
+import httpx
+import pytest
+from tortoise import Tortoise, connections
+from tortoise.utils import generate_schema_for_client, get_schema_sql
+
+from fircode import config, db_router
+from fircode.db_router import ReadYourWritesMiddleware
+from fircode.models import Dog, Gender
+
+
+async def names() -> list:
+    return sorted(await Dog.all().values_list("name", flat=True))
+
+
+async def create_dog(name: str, using_db=None) -> None:
+    await Dog.create(name=name, age=1, description="", gender=Gender.male, using_db=using_db)
+
+
+@pytest.fixture
+def replica(monkeypatch, own_connections):
+    monkeypatch.setattr(config, "replica_connections", ["replica_0"])
+    monkeypatch.setattr(db_router, "_replicas", itertools.cycle(["replica_0"]))
+
+
+def run(directory, check) -> None:
+    """Runs the check against a primary and a replica, which have a different dog each"""
+    async def setup() -> None:
+        await Tortoise.init(config={
+            **config.tortoise_config,
+            "connections": {
+                config.primary_connection: config._sqlite_connection(os.path.join(directory, "primary.sqlite3")),
+                "replica_0": config._sqlite_connection(os.path.join(directory, "replica.sqlite3")),
+            },
+        })
+        primary = connections.get(config.primary_connection)
+        await generate_schema_for_client(primary, safe=True)
+        # Models belong to the primary, so the replica gets the same schema by SQL
+        await connections.get("replica_0").execute_script(get_schema_sql(primary, safe=True))
+        await create_dog("on primary", using_db=connections.get(config.primary_connection))
+        await create_dog("on replica", using_db=connections.get("replica_0"))
+
+    async def main() -> None:
+        # A task gets a copy of the context, so the setup doesn't pin the check to the primary
+        try:
+            await asyncio.create_task(setup())
+            await check()
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_reads_go_to_replica(replica, tmp_path):
+    async def check() -> None:
+        assert await names() == ["on replica"]
+
+    run(tmp_path, check)
+
+
+def test_writes_go_to_primary(replica, tmp_path):
+    async def check() -> None:
+        await create_dog("written")
+        primary = connections.get(config.primary_connection)
+        _, rows = await primary.execute_query('SELECT "name" FROM "dog" ORDER BY "name"')
+        assert [row["name"] for row in rows] == ["on primary", "written"]
+        _, rows = await connections.get("replica_0").execute_query('SELECT "name" FROM "dog"')
+        assert [row["name"] for row in rows] == ["on replica"]
+
+    run(tmp_path, check)
+
+
+def test_request_reads_its_writes_from_primary(replica, tmp_path):
+    seen = []
+
+    async def app(scope, receive, send) -> None:
+        before = await names()
+        if scope["method"] == "POST":
+            await create_dog("written")
+        seen.append((before, await names()))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def check() -> None:
+        transport = httpx.ASGITransport(app=ReadYourWritesMiddleware(app))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.post("/")
+            await client.get("/")
+
+    run(tmp_path, check)
+    assert seen == [
+        # Pinned to the primary after the write
+        (["on replica"], ["on primary", "written"]),
+        # The next request starts on the replica again
+        (["on replica"], ["on replica"]),
+    ]
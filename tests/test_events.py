@@ -0,0 +1,29 @@
+import asyncio
+
+from fircode.events import EventHub, MemoryBackend
+
+
+def test_feed_request_events_reach_admins_and_requester_only():
+    async def main() -> dict:
+        hub = EventHub(MemoryBackend(), queue_size=16, keepalive=15)
+        await hub.start()
+        subscriptions = {
+            "admin": hub.subscribe("admin@example.com", is_admin=True),
+            "requester": hub.subscribe("user0@example.com", is_admin=False),
+            "other": hub.subscribe("user1@example.com", is_admin=False),
+        }
+        await hub.publish("feed_request.created", {"id": 1, "actor_id": "user0@example.com"},
+                          audience="user0@example.com")
+        await hub.publish("dog.updated", {"id": 2})
+        received = {}
+        for name, subscription in subscriptions.items():
+            received[name] = []
+            while not subscription.queue.empty():
+                received[name].append(subscription.queue.get_nowait().decode("utf-8").split("\n", 1)[0])
+        return received
+
+    assert asyncio.run(main()) == {
+        "admin": ["event: feed_request.created", "event: dog.updated"],
+        "requester": ["event: feed_request.created", "event: dog.updated"],
+        "other": ["event: dog.updated"],
+    }
@@ -0,0 +1,52 @@
+import bisect
+import random
+
+import pytest
+
+from fircode.leaderboard import Leaderboard
+from fircode.sorted_keys import SortedKeys
+
+
+def test_sorted_keys_match_sorted_list():
+    generator = random.Random(0)
+    expected = sorted(generator.randrange(100) for _ in range(200))
+    keys = SortedKeys(expected)
+    for _ in range(2000):
+        key = generator.randrange(120)
+        if expected and generator.random() < 0.5:
+            key = generator.choice(expected)
+            expected.remove(key)
+            keys.remove(key)
+        else:
+            bisect.insort(expected, key)
+            keys.add(key)
+        assert len(keys) == len(expected)
+        probe = generator.randrange(120)
+        assert keys.bisect_left(probe) == bisect.bisect_left(expected, probe)
+        start = generator.randrange(len(expected) + 2)
+        assert keys[start:start + 5] == expected[start:start + 5]
+    assert list(keys) == expected
+
+
+def test_sorted_keys_remove_missing():
+    keys = SortedKeys([1, 3])
+    with pytest.raises(ValueError):
+        keys.remove(2)
+    assert list(keys) == [1, 3]
+
+
+def test_leaderboard_ranks():
+    leaderboard = Leaderboard(refresh_interval=60)
+    leaderboard.load([("a@example.com", 5), ("b@example.com", 10), ("c@example.com", 5), ("d@example.com", 1)])
+    assert leaderboard.top(3) == [(1, "b@example.com", 10), (2, "a@example.com", 5), (2, "c@example.com", 5)]
+
+    leaderboard.add("d@example.com", 20)
+    leaderboard.set("e@example.com", 7)
+    leaderboard.remove("b@example.com")
+    assert leaderboard.rank("d@example.com") == 1
+    assert leaderboard.rank("e@example.com") == 2
+    assert leaderboard.rank("c@example.com") == 3
+    assert leaderboard.rank("b@example.com") is None
+    assert leaderboard.around("e@example.com", 1) == [
+        (1, "d@example.com", 21), (2, "e@example.com", 7), (3, "a@example.com", 5)]
+    assert len(leaderboard) == 4
@@ -0,0 +1,67 @@
+import asyncio
+import base64
+import json
+import types
+from datetime import date
+
+import httpx
+import pytest
+from asgi_lifespan import LifespanManager
+from fastapi.exceptions import HTTPException
+
+from fircode.models import Dog, FeedRequest, Gender
+from fircode.pagination import Keyset
+
+
+def encoded(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii")
+
+
+def feed_request_keyset(order: str) -> Keyset:
+    # Cursors need the model only, a queryset would need database connections
+    return Keyset(types.SimpleNamespace(model=FeedRequest), order)
+
+
+def test_cursor_round_trip():
+    keyset = feed_request_keyset("-arrived_at")
+    assert keyset.ordering == ("-arrived_at", "-id")
+    cursor = keyset.encode_cursor({"arrived_at": date(2024, 5, 1), "id": 7})
+    assert keyset.decode_cursor(cursor) == (date(2024, 5, 1), 7)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!", encoded("text"), encoded([1]), encoded(["2024-05-01", 7, 8]), encoded(["yesterday", 7]),
+    encoded(["2024-05-01", "seven"]), encoded(5),
+])
+def test_bad_cursor(cursor):
+    with pytest.raises(HTTPException) as error:
+        feed_request_keyset("arrived_at").decode_cursor(cursor)
+    assert error.value.status_code == 422
+
+
+def test_pages_cover_the_list():
+    async def main() -> None:
+        from fircode.main import api_app, app
+
+        async with LifespanManager(app):
+            # Equal feed amounts are ordered by id
+            await Dog.bulk_create([Dog(name=f"Страница {i}", age=1, description="", gender=Gender.female,
+                                       feed_amount=i % 3) for i in range(7)])
+            transport = httpx.ASGITransport(app=api_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                everything = (await client.get("/dogs")).json()
+                pages, cursor = [], None
+                while True:
+                    response = await client.get("/dogs", params={"limit": 3, **({"cursor": cursor} if cursor else {})})
+                    assert response.status_code == 200
+                    pages += response.json()
+                    cursor = response.headers.get("X-Next-Cursor")
+                    if cursor is None:
+                        break
+                assert [dog["id"] for dog in pages] == [dog["id"] for dog in everything]
+                assert [dog["feed_amount"] for dog in pages] == sorted(dog["feed_amount"] for dog in pages)
+
+                response = await client.get("/dogs", params={"limit": 3, "cursor": "not a cursor"})
+                assert response.status_code == 422
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""Queries per request of list and profile routes must not grow with the number of rows
+
+Relations are loaded with joins and batched prefetches, a query per row would show up here.
+"""
+import asyncio
+import logging
+import random
+from datetime import date
+
+import httpx
+from asgi_lifespan import LifespanManager
+
+from tests.main import Context, QueryCounter, login, seed, user_password
+
+routes = ("/dogs", "/users_stat", "/feed_requests", "/feed_requests/current", "/user")
+rows = 30
+
+
+async def reseed(context: Context) -> None:
+    """Replace users (except the admin), dogs and feed requests with a new set"""
+    from fircode import config
+    from fircode.models import Dog, FeedRequest, SessionToken, User
+
+    # all() binds the queryset to a read connection, filter() leaves it to the router
+    await FeedRequest.filter().delete()
+    await Dog.filter().delete()
+    await SessionToken.exclude(user_id=config.admin_email).delete()
+    await User.exclude(email=config.admin_email).delete()
+    await seed(context)
+    # Requests of the logged in user, so /feed_requests/current grows with the rest
+    dog_ids = context.values["dog_ids"]
+    await FeedRequest.bulk_create([
+        FeedRequest(actor_id="user0@example.com", target_id=dog_ids[i % len(dog_ids)], feed_amount=1,
+                    arrived_at=date(2024, 1, 1 + i % 28))
+        for i in range(context.dogs)
+    ])
+
+
+async def count_queries(client, counter: QueryCounter) -> dict:
+    from fircode.response_cache import dog_cache
+    from fircode.session import session_cache
+
+    session_cache.clear()
+    cookies = await login(client, "user0@example.com", user_password)
+    counts = {}
+    for route in routes:
+        # Cached responses would hide the queries
+        dog_cache.invalidate()
+        counter.count = 0
+        response = await client.get(route, cookies=cookies)
+        assert response.status_code == 200, f"{route}: {response.status_code} {response.text}"
+        assert response.json(), f"{route} returned nothing"
+        counts[route] = counter.count
+    return counts
+
+
+async def measure() -> tuple:
+    from fircode.main import api_app, app
+
+    counter = QueryCounter()
+    db_logger = logging.getLogger("tortoise.db_client")
+    level, propagate = db_logger.level, db_logger.propagate
+    db_logger.setLevel(logging.DEBUG)
+    db_logger.propagate = False
+    db_logger.addHandler(counter)
+    try:
+        async with LifespanManager(app):
+            transport = httpx.ASGITransport(app=api_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await reseed(Context(users=rows, dogs=rows, feed_requests=rows * 3))
+                small = await count_queries(client, counter)
+                await reseed(Context(users=rows * 10, dogs=rows * 10, feed_requests=rows * 30))
+                large = await count_queries(client, counter)
+    finally:
+        db_logger.removeHandler(counter)
+        db_logger.setLevel(level)
+        db_logger.propagate = propagate
+    return small, large
+
+
+def test_query_counts_dont_grow_with_rows():
+    random.seed(0)
+    small, large = asyncio.run(measure())
+    assert all(small.values()), small
+    assert small == large
@@ -0,0 +1,69 @@
+import types
+
+import pytest
+
+from fircode import rate_limit
+from fircode.exceptions import RateLimited
+from fircode.rate_limit import RateLimiter, SharedBuckets
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(rate_limit, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def buckets(tmp_path):
+    return SharedBuckets(str(tmp_path / "buckets"), slots=64)
+
+
+def test_bucket_refills_at_limit_per_window(clock, buckets):
+    limits = [("login:ip:1.2.3.4", 3, 60)]
+    for _ in range(3):
+        assert buckets.acquire(limits) == (0.0, None)
+    # A token comes back every window / limit seconds
+    assert buckets.acquire(limits) == (pytest.approx(20), 0)
+    clock.now += 15
+    assert buckets.acquire(limits) == (pytest.approx(5), 0)
+    clock.now += 5
+    assert buckets.acquire(limits) == (0.0, None)
+    assert buckets.acquire(limits)[1] == 0
+    # A bucket never holds more than the limit
+    clock.now += 600
+    for _ in range(3):
+        assert buckets.acquire(limits) == (0.0, None)
+    assert buckets.acquire(limits)[1] == 0
+
+
+def test_rejected_acquire_takes_no_tokens(clock, buckets):
+    ip = ("login:ip:1.2.3.4", 3, 60)
+    assert buckets.acquire([ip, ("login:email:a@example.com", 1, 60)]) == (0.0, None)
+    # The email bucket is empty, so the IP bucket keeps its token
+    assert buckets.acquire([ip, ("login:email:a@example.com", 1, 60)]) == (pytest.approx(60), 1)
+    assert buckets.acquire([ip, ("login:email:b@example.com", 1, 60)]) == (0.0, None)
+    assert buckets.acquire([ip, ("login:email:c@example.com", 1, 60)]) == (0.0, None)
+    assert buckets.acquire([ip, ("login:email:d@example.com", 1, 60)]) == (pytest.approx(20), 0)
+
+
+def test_buckets_are_shared_through_the_file(clock, tmp_path):
+    first = SharedBuckets(str(tmp_path / "buckets"), slots=64)
+    second = SharedBuckets(str(tmp_path / "buckets"), slots=64)
+    limits = [("registration:ip:1.2.3.4", 2, 60)]
+    assert first.acquire(limits) == (0.0, None)
+    assert second.acquire(limits) == (0.0, None)
+    assert first.acquire(limits)[1] == 0
+
+
+def test_limiter_raises_and_counts(clock, buckets):
+    limiter = RateLimiter(buckets, enabled=True, window=60)
+    limiter.check("login", "1.2.3.4", "a@example.com", ip_limit=10, email_limit=1)
+    with pytest.raises(RateLimited) as error:
+        limiter.check("login", "5.6.7.8", "a@example.com", ip_limit=10, email_limit=1)
+    assert error.value.retry_after == pytest.approx(60)
+    assert limiter.stats() == {"enabled": True, "allowed": 1, "rejected_login_email": 1}
+
+    disabled = RateLimiter(buckets, enabled=False, window=60)
+    for _ in range(5):
+        disabled.check("login", "5.6.7.8", "a@example.com", ip_limit=10, email_limit=1)
@@ -0,0 +1,83 @@
+"""Upgrades of databases created by older versions"""
+import asyncio
+import os
+import secrets
+
+import pytest
+from starlette.requests import Request
+from tortoise import Tortoise, connections
+
+from fircode import config, db_router, startup
+from fircode.models import SessionToken
+from fircode.session import get_current_user, session_cache, token_digest
+
+# Tables of the version before hashed session tokens
+baseline_schema = """
+CREATE TABLE "user" (
+    "email" VARCHAR(254) NOT NULL PRIMARY KEY,
+    "phone" VARCHAR(32) NOT NULL,
+    "first_name" VARCHAR(64) NOT NULL,
+    "second_name" VARCHAR(64) NOT NULL,
+    "is_admin" INT NOT NULL,
+    "hashed_password" VARCHAR(512) NOT NULL,
+    "contribution" INT NOT NULL
+);
+CREATE TABLE "session_token" (
+    "token" VARCHAR(512) NOT NULL PRIMARY KEY,
+    "user_id" VARCHAR(254) NOT NULL REFERENCES "user" ("email") ON DELETE CASCADE
+);
+"""
+
+
+@pytest.fixture
+def primary_only(monkeypatch, own_connections):
+    monkeypatch.setattr(config, "replica_connections", [])
+    monkeypatch.setattr(db_router, "_replicas", iter(()))
+    # Every boot runs the upgrades, as if the previous one had been interrupted
+    monkeypatch.setattr(config, "schema_version_check", False)
+
+
+async def upgrade_baseline(directory, token: str, upgrade) -> None:
+    """Runs the upgrade against a database of the older version with a session of the token"""
+    await Tortoise.init(config={
+        **config.tortoise_config,
+        "connections": {
+            config.primary_connection: config._sqlite_connection(os.path.join(directory, "baseline.sqlite3")),
+        },
+    })
+    try:
+        primary = connections.get(config.primary_connection)
+        await primary.execute_script(baseline_schema)
+        await primary.execute_query(
+            """INSERT INTO "user" VALUES ('old@example.com', '+70000000000', 'Old', 'User', 0, 'x', 0)""")
+        await primary.execute_query('INSERT INTO "session_token" VALUES (?, ?)', [token, "old@example.com"])
+
+        await upgrade()
+
+        session_cache.clear()
+        request = Request({"type": "http", "headers": [(b"cookie", f"session={token}".encode())]})
+        identity = await get_current_user(request)
+        assert identity.email == "old@example.com"
+        assert await SessionToken.all().values_list("token", flat=True) == [token_digest(token)]
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_sessions_survive_upgrade(primary_only, tmp_path):
+    # Tokens of the older version were generated with the same length
+    token = secrets.token_urlsafe(config.session_token_lenght)
+    assert len(token) > 64
+
+    async def upgrade() -> None:
+        await startup.create_schemas()
+        await startup.create_schemas()
+
+    asyncio.run(upgrade_baseline(tmp_path, token, upgrade))
+
+
+def test_concurrent_upgrades(primary_only, tmp_path):
+    async def upgrade() -> None:
+        # Like workers on their first boot, both find the columns missing
+        await asyncio.gather(startup.create_schemas(), startup.create_schemas())
+
+    asyncio.run(upgrade_baseline(tmp_path, secrets.token_urlsafe(config.session_token_lenght), upgrade))